@@ -0,0 +1,378 @@
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import gpytorch
+import numpy as np
+import torch
+
+from covid import CovidData
+from cache import GraphCache
+from relational import *
+from model import NodeGPModel, get_node_data, get_skeleton_values
+from owscm_port.estimation import conditional_ITE
+from policy import ComputePolicy, get_dtype, get_global_policy, policy_context, set_global_policy
+import instrument
+
+# Peak memory per unit of work, measured on the covid populations with run_stage
+# Adjacency matrices are built from nested lists of pointers before pandas converts them to bools
+BYTES_PER_ADJACENCY_CELL = 12
+# Skeleton, networkx ground graph and pickled copies of it
+BYTES_PER_INSTANCE = 2048
+
+# Each stage runs after the stage it depends on, and is skipped once it has hit its time budget
+STAGE_DEPENDENCIES = {
+    'generate': None,
+    'load_skeleton': 'generate',
+    'adjacency': 'load_skeleton',
+    'adjacency_cached': 'adjacency',
+    'ground_graph': 'load_skeleton',
+    'ground_graph_cached': 'ground_graph',
+    'subgraph': 'ground_graph',
+    'kernel': 'adjacency',
+    'effect': 'kernel'
+}
+
+def population_shape(num_businesses: int) -> tuple:
+    """ Split a number of businesses evenly into states, towns per state and businesses per town
+
+    Args:
+        num_businesses (int): total number of businesses
+
+    Returns:
+        tuple: number of states, towns per state and businesses per town
+    """
+    per_level = max(2, round(num_businesses ** (1 / 3)))
+    num_states = max(1, round(num_businesses / per_level ** 2))
+    return num_states, per_level, per_level
+
+def estimate_stage_bytes(name: str, size: int, num_draws: int, dtype_bytes: int) -> int:
+    """ Rough peak memory of a stage, so that stages that would not fit in memory are skipped before they run
+
+    Args:
+        name (str): stage name
+        size (int): number of businesses
+        num_draws (int): number of hyperparameter draws in the effect stage
+        dtype_bytes (int): bytes per element of the compute dtype
+
+    Returns:
+        int: estimated peak bytes
+    """
+    num_states, towns_per_state, businesses_per_town = population_shape(size)
+    num_towns = num_states * towns_per_state
+    num_businesses = num_towns * businesses_per_town
+    num_instances = num_states + num_towns + num_businesses
+    # Dense adjacency matrices of contains (state x town) and resides (town x business)
+    adjacency_cells = num_states * num_towns + num_towns * num_businesses
+    estimates = {
+        'generate': BYTES_PER_INSTANCE * num_instances,
+        'load_skeleton': BYTES_PER_INSTANCE * num_instances,
+        'adjacency': BYTES_PER_ADJACENCY_CELL * adjacency_cells,
+        # Cache hits memory-map the stored matrices
+        'adjacency_cached': adjacency_cells,
+        'ground_graph': BYTES_PER_INSTANCE * num_instances,
+        'ground_graph_cached': BYTES_PER_INSTANCE * num_instances,
+        'subgraph': BYTES_PER_INSTANCE * num_instances,
+        # Dense float64 town x business relation matrix cast to the compute dtype, and a few town x town kernel matrices
+        'kernel': (8 + dtype_bytes) * num_towns * num_businesses + 4 * dtype_bytes * num_towns ** 2,
+        # A few town x town covariances per hyperparameter draw
+        'effect': 4 * dtype_bytes * num_draws * num_towns ** 2
+    }
+    return estimates[name]
+
+def get_memory_limit() -> int:
+    # Half of the physical memory, the rest is left to the process that runs the stages and the system
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError):
+        return 2 ** 33
+
+def stage_generate(state):
+    covid = CovidData()
+    covid.num_states, covid.num_towns_per_state, covid.num_businesses_per_town = population_shape(state['size'])
+    covid.generate_data()
+    state['paths'] = covid.write_relational_files(state['data_dir'])
+
+def stage_load_skeleton(state):
+    schema = RelationalSchema()
+    schema.load_from_file(state['paths']['schema'])
+    skeleton = RelationalSkeleton(schema)
+    skeleton.load_from_file(schema, state['paths']['skeleton'])
+    structure = RelationalCausalStructure(schema)
+    structure.load_edges_from_file(state['paths']['structure'])
+    state.update(schema = schema, skeleton = skeleton, structure = structure)
+
+def stage_adjacency(state):
+    # A miss, which builds the matrices and stores them in the cache of this size
+    state['adj_mat_dict'] = state['cache'].get_adj_mat_dict(state['structure'], state['skeleton'])
+
+def stage_adjacency_cached(state):
+    state['cache'].get_adj_mat_dict(state['structure'], state['skeleton'])
+
+def stage_ground_graph(state):
+    state['ground_graph'] = state['cache'].get_ground_graph(state['structure'], state['skeleton'])
+
+def stage_ground_graph_cached(state):
+    state['cache'].get_ground_graph(state['structure'], state['skeleton'])
+
+def stage_subgraph(state):
+    skeleton = state['skeleton']
+    treatment = InstanceNode("state", "policy", skeleton.entity_instances["state"]["names"][0])
+    outcome = InstanceNode("town", "prevalence", skeleton.entity_instances["town"]["names"][0])
+    create_subgraph_for_ITE(state['ground_graph'], treatment, outcome)
+
+def stage_kernel(state):
+    values = get_skeleton_values(state['structure'], state['skeleton'])
+    train_x, parents = get_node_data(state['structure'], state['adj_mat_dict'], "town", "prevalence", values)
+    train_y = values[RelationalNode("town", "prevalence")]
+    state['units'] = (train_x, train_y, list(parents))
+    # Covariance over all towns from the kernel the node GPs are fitted with
+    model = NodeGPModel(train_x, train_y, gpytorch.likelihoods.GaussianLikelihood(), parents).to(get_dtype())
+    with torch.no_grad(), model.solver_context():
+        state['cov'] = model.covar_module(train_x).to_dense()
+
+def stage_effect(state):
+    train_x, y, parents = state['units']
+    dtype = get_dtype()
+    columns = {relation: train_x[:, i].to(dtype) for i, (relation, _) in enumerate(parents)}
+    # Towns as units: the state policy confounds, the mean business occupancy is a covariate and the town policy is the treatment
+    num_draws = state['num_draws']
+    hyperparams = torch.ones(num_draws, dtype = dtype)
+    conditional_ITE(hyperparams, hyperparams, hyperparams, 0.1 * hyperparams, hyperparams,
+                    columns['contains'], columns['resides'], columns['self'], y.to(dtype), torch.tensor([0., 1.]))
+
+STAGES = {
+    'generate': stage_generate,
+    'load_skeleton': stage_load_skeleton,
+    'adjacency': stage_adjacency,
+    'adjacency_cached': stage_adjacency_cached,
+    'ground_graph': stage_ground_graph,
+    'ground_graph_cached': stage_ground_graph_cached,
+    'subgraph': stage_subgraph,
+    'kernel': stage_kernel,
+    'effect': stage_effect
+}
+
+def reset_peak_rss() -> bool:
+    """ Reset the peak resident memory of the process, so that VmHWM only covers what runs afterwards
+
+    Returns:
+        bool: whether the peak could be reset, which needs Linux procfs
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_peak_rss() -> int:
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_stage(name: str, state: dict, profile_memory: bool) -> dict:
+    """ Time a stage and record the peak resident memory while it runs
+
+    The peak is measured on the resident memory, so it includes torch and numpy buffers.
+    It is exact where the peak of the process can be reset, and sampled by instrument otherwise.
+
+    Args:
+        name (str): stage name
+        state (dict): inputs and outputs shared between stages
+        profile_memory (bool): whether to also trace Python allocations, which slows down the stage
+
+    Returns:
+        dict: record with the stage timing, its peak resident memory and the increase over the memory before the stage
+    """
+    sampled = not reset_peak_rss()
+    was_enabled = instrument.is_enabled()
+    if sampled:
+        instrument.enable(sample_memory = True)
+    if profile_memory:
+        tracemalloc.start()
+    rss_before = instrument.current_rss()
+    start = time.perf_counter()
+    with instrument.timer(f'benchmark.{name}'):
+        STAGES[name](state)
+    seconds = time.perf_counter() - start
+    if sampled:
+        peak_rss = instrument.get_stats()['stages'][f'benchmark.{name}'].get('peak_rss_bytes', rss_before)
+        if not was_enabled:
+            instrument.disable()
+    else:
+        peak_rss = get_peak_rss()
+    peak_rss = max(peak_rss, instrument.current_rss())
+    record = {'stage': name, 'size': state['size'], 'seconds': seconds,
+              'peak_rss_bytes': peak_rss, 'peak_rss_increase_bytes': peak_rss - rss_before}
+    if profile_memory:
+        # Python allocations only, torch and numpy buffers are not traced
+        record['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return record
+
+def get_policy_label(policy: ComputePolicy) -> str:
+    threads = 'default' if policy.intra_op_threads is None else policy.intra_op_threads
+    return f"{policy.dtype}/threads={threads}" + ("/deterministic" if policy.deterministic else "")
+
+def run_benchmark(sizes: list, stage_budget: float = 60., profile_memory: bool = False, num_draws: int = 16, 
+                  max_stage_bytes: int = None, policy: ComputePolicy = None, on_record = None) -> list:
+    """ Run all pipeline stages on covid populations of growing size
+
+    Args:
+        sizes (list): number of businesses in each population
+        stage_budget (float, optional): seconds after which a stage and its dependents are skipped for larger sizes. Defaults to 60.
+        profile_memory (bool, optional): whether to also record peak traced Python memory. Defaults to False.
+        num_draws (int, optional): number of hyperparameter draws in the effect stage. Defaults to 16.
+        max_stage_bytes (int, optional): a stage and its dependents are skipped once estimate_stage_bytes is above this. 
+                                         Defaults to half of the physical memory.
+        policy (ComputePolicy, optional): compute policy for all stages. Defaults to the global policy.
+        on_record (callable, optional): called with every record as soon as its stage finishes or is skipped. Defaults to None.
+
+    Returns:
+        list: one record per stage and size, labelled with the policy
+    """
+    previous_policy = get_global_policy()
+    previous_threads = torch.get_num_threads()
+    policy = previous_policy if policy is None else policy
+    set_global_policy(policy)
+    max_stage_bytes = get_memory_limit() if max_stage_bytes is None else max_stage_bytes
+    try:
+        with policy_context(policy):
+            records = _run_stages(sizes, stage_budget, profile_memory, num_draws, max_stage_bytes, policy, on_record)
+    finally:
+        set_global_policy(previous_policy)
+        torch.set_num_threads(previous_threads)
+    return records
+
+def _run_stages(sizes: list, stage_budget: float, profile_memory: bool, num_draws: int, max_stage_bytes: int,
+                policy: ComputePolicy, on_record) -> list:
+    label = get_policy_label(policy)
+    dtype_bytes = torch.finfo(get_dtype(policy)).bits // 8
+    records = []
+    skipped = {} # key is a stage that is skipped for all larger sizes and value is the reason
+    for size in sorted(sizes):
+        np.random.seed(0)
+        with tempfile.TemporaryDirectory() as data_dir:
+            state = {'size': size, 'data_dir': data_dir + '/', 'num_draws': num_draws,
+                     'cache': GraphCache(os.path.join(data_dir, 'cache'))}
+            for name, dependency in STAGE_DEPENDENCIES.items():
+                estimated_bytes = estimate_stage_bytes(name, size, num_draws, dtype_bytes)
+                if name not in skipped:
+                    if dependency in skipped:
+                        skipped[name] = f'dependency {dependency} skipped'
+                    elif estimated_bytes > max_stage_bytes:
+                        skipped[name] = 'memory'
+                if name in skipped:
+                    record = {'stage': name, 'size': size, 'skipped': True, 'reason': skipped[name], 'estimated_bytes': estimated_bytes}
+                    print(f"{size:>10} {name:<20} {'skipped':>11} ({skipped[name]})")
+                else:
+                    record = run_stage(name, state, profile_memory)
+                    record['estimated_bytes'] = estimated_bytes
+                    print(f"{size:>10} {name:<20} {record['seconds']:10.3f}s")
+                    if record['seconds'] > stage_budget:
+                        skipped[name] = 'time'
+                record['policy'] = label
+                records.append(record)
+                if on_record is not None:
+                    on_record(record)
+    return records
+
+# Modules that schema and skeleton handling must not import
+HEAVY_MODULES = ['torch', 'pandas', 'networkx', 'gpytorch', 'pyro', 'matplotlib', 'GPy']
+# Seconds allowed for importing relational, checked by tests/test_import_time.py
+IMPORT_BUDGET = 0.5
+
+def measure_import(module: str = 'relational') -> dict:
+    """ Import a module in a fresh interpreter and measure how long it takes
+
+    Args:
+        module (str, optional): module to import. Defaults to 'relational'.
+
+    Returns:
+        dict: record with the import time and the heavy modules that were loaded
+    """
+    code = (f"import json, sys, time; start = time.perf_counter(); import {module}; "
+            f"print(json.dumps([time.perf_counter() - start, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))")
+    output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True,
+                            cwd = os.path.dirname(os.path.abspath(__file__)))
+    seconds, heavy_modules = json.loads(output.stdout.strip().splitlines()[-1])
+    return {'stage': f'import_{module}', 'size': 0, 'seconds': seconds, 'heavy_modules': heavy_modules}
+
+def save_records(records: list, path: str):
+    # Replace the file in one step, so that it always holds a complete list
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(records, f, indent = 4)
+    os.replace(tmp_path, path)
+
+def find_regressions(records: list, baseline: list, tolerance: float = 0.25, min_seconds: float = 0.05) -> list:
+    """ Compare stage timings to a stored baseline
+
+    Args:
+        records (list): records from run_benchmark
+        baseline (list): records from an earlier run
+        tolerance (float, optional): allowed relative slowdown. Defaults to 0.25.
+        min_seconds (float, optional): slowdowns smaller than this are ignored as noise. Defaults to 0.05.
+
+    Returns:
+        list: records that are slower than the baseline, with the baseline timing added
+    """
+    baseline_seconds = {(r['stage'], r['size'], r.get('policy')): r['seconds'] for r in baseline if 'seconds' in r}
+    regressions = []
+    for record in records:
+        reference = baseline_seconds.get((record['stage'], record['size'], record.get('policy')))
+        if reference is None or 'seconds' not in record:
+            continue
+        if record['seconds'] > reference * (1 + tolerance) and record['seconds'] - reference > min_seconds:
+            regressions.append({**record, 'baseline_seconds': reference})
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Scaling benchmark for the relational pipeline")
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10 ** 2, 10 ** 4, 10 ** 6], help = "numbers of businesses")
+    parser.add_argument('--stage-budget', type = float, default = 60., help = "seconds before a stage is skipped for larger sizes")
+    parser.add_argument('--max-stage-bytes', type = int, default = None, 
+                        help = "stages estimated to need more memory are skipped, defaults to half of the physical memory")
+    parser.add_argument('--memory', action = 'store_true', help = "also record peak traced Python memory per stage")
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', default = None, help = "results file to compare against")
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--import-budget', type = float, default = IMPORT_BUDGET, help = "seconds allowed for importing relational")
+    parser.add_argument('--dtypes', nargs = '+', default = ['float32'], help = "dtypes to compare, e.g. float32 float64")
+    parser.add_argument('--threads', type = int, nargs = '+', default = [None], help = "intra-op thread counts to compare")
+    parser.add_argument('--deterministic', action = 'store_true')
+    args = parser.parse_args()
+
+    import_record = measure_import('relational')
+    print(f"{'':>10} {import_record['stage']:<20} {import_record['seconds']:10.3f}s")
+    if import_record['seconds'] > args.import_budget or import_record['heavy_modules']:
+        print(f"Importing relational took {import_record['seconds']:.3f}s and loaded {import_record['heavy_modules']}")
+        raise SystemExit(1)
+
+    # Records are written after every stage, so that a run that is killed keeps the stages it finished
+    records = []
+    def add_record(record):
+        records.append(record)
+        save_records(records, args.output)
+    add_record(import_record)
+    for dtype, threads in itertools.product(args.dtypes, args.threads):
+        policy = ComputePolicy(dtype = dtype, intra_op_threads = threads, deterministic = args.deterministic)
+        print(f"Policy {get_policy_label(policy)}")
+        run_benchmark(args.sizes, args.stage_budget, args.memory, max_stage_bytes = args.max_stage_bytes, policy = policy, on_record = add_record)
+
+    if args.baseline is not None and os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            regressions = find_regressions(records, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"Regression in {r['stage']} at size {r['size']}: {r['seconds']:.3f}s vs {r['baseline_seconds']:.3f}s")
+        if regressions:
+            raise SystemExit(1)
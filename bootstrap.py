@@ -0,0 +1,220 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import torch
+
+# Import classes and functions for relational models
+from relational import *
+from model import fit_relational_scm
+from estimation import batch_effect_estimation
+from partition import find_components, split_skeleton
+import instrument
+
+# Components and attribute values seen by the replicates of the current process
+_worker_state = {}
+
+def get_component_data(structure: RelationalCausalStructure, skeleton: RelationalSkeleton, labels: np.ndarray) -> tuple:
+    """ Instances and adjacency edges of every connected component
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): contains all instances
+        labels (np.ndarray): component label of every instance from find_components
+
+    Returns:
+        tuple: list with one dict per component, with the instance names and their positions among all instances of every entity
+               and the range of its edges for every relation, and the edges as a dict where the key is a relation or relation path
+               and the value is a (row entity, column entity, rows, columns) tuple of the related instances, numbered within each component
+    """
+    components = []
+    edges = {}
+    for component_skeleton, members in split_skeleton(structure.schema, skeleton, labels, return_members = True):
+        # Adjacency matrices of a component are blocks of the full ones, so their edges are found once for all replicates
+        edge_ranges = {}
+        for relation, adj_mat in create_adj_mat_dict(structure, component_skeleton).items():
+            rows, cols = np.nonzero(adj_mat.to_numpy(dtype = bool))
+            row_entity, col_entity, all_rows, all_cols = edges.setdefault(relation, (*structure.get_relation_entities(relation), [], []))
+            start = sum(len(r) for r in all_rows)
+            all_rows.append(rows)
+            all_cols.append(cols)
+            edge_ranges[relation] = (start, start + len(rows))
+        components.append({
+            "names": {entity: instances["names"] for entity, instances in component_skeleton.entity_instances.items()},
+            "index": members,
+            "edges": edge_ranges
+        })
+    edges = {relation: (row_entity, col_entity, np.concatenate(rows).astype(np.int64), np.concatenate(cols).astype(np.int64))
+             for relation, (row_entity, col_entity, rows, cols) in edges.items()}
+    return components, edges
+
+def create_replicate(schema: RelationalSchema, components: list, edges: dict, picks: np.ndarray, attribute_values: dict) -> tuple:
+    """ Skeleton and adjacency matrices of a bootstrap replicate
+
+    Instances of a component that is picked more than once get a suffix with the position of the pick,
+    and the adjacency matrices are block diagonal in the picked components.
+
+    Args:
+        schema (RelationalSchema): relational schema
+        components (list): components from get_component_data
+        edges (dict): edges from get_component_data, e.g. mapped from shared memory
+        picks (np.ndarray): indices of the components in the replicate
+        attribute_values (dict): key is (entity, attribute) and value is an array over all instances of the entity
+
+    Returns:
+        tuple: RelationalSkeleton and adjacency matrices of the replicate
+    """
+    skeleton = RelationalSkeleton(schema)
+    # Position of the first instance of every entity of every pick in the replicate
+    offsets = {}
+    for entity, attributes in schema.attribute_classes.items():
+        names = []
+        index = []
+        offsets[entity] = []
+        for k, c in enumerate(picks):
+            offsets[entity].append(len(names))
+            names += [f"{name}~{k}" for name in components[c]["names"][entity]]
+            index.append(components[c]["index"][entity])
+        index = np.concatenate(index) if index else np.zeros(0, dtype = int)
+        skeleton.entity_instances[entity] = {"names": names}
+        for attribute in attributes:
+            skeleton.entity_instances[entity][attribute] = attribute_values[(entity, attribute)][index].tolist()
+        skeleton.instance_type.update((name, entity) for name in names)
+
+    adj_mat_dict = {}
+    for relation, (row_entity, col_entity, rows, cols) in edges.items():
+        ranges = [components[c]["edges"][relation] for c in picks]
+        replicate_rows = np.concatenate([rows[start:end] + offsets[row_entity][k] for k, (start, end) in enumerate(ranges)])
+        replicate_cols = np.concatenate([cols[start:end] + offsets[col_entity][k] for k, (start, end) in enumerate(ranges)])
+        row_names = skeleton.entity_instances[row_entity]["names"]
+        col_names = skeleton.entity_instances[col_entity]["names"]
+        adj_mat = np.zeros((len(row_names), len(col_names)), dtype = bool)
+        adj_mat[replicate_rows, replicate_cols] = True
+        adj_mat_dict[relation] = pd.DataFrame(adj_mat, index = row_names, columns = col_names)
+        if relation in skeleton.relationship_instances:
+            skeleton.relationship_instances[relation] = [[row_names[r], col_names[c]] for r, c in zip(replicate_rows.tolist(), replicate_cols.tolist())]
+    return skeleton, adj_mat_dict
+
+def _share_arrays(arrays: dict) -> tuple:
+    # Copy arrays into shared memory, the returned spec of each array is enough to map it in another process
+    handles = {}
+    shared = {}
+    for key, values in arrays.items():
+        handle = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype = values.dtype, buffer = handle.buf)[:] = values
+        handles[key] = handle
+        shared[key] = (handle.name, values.shape, values.dtype.str)
+    return handles, shared
+
+def _init_worker(shared: dict, schema, structure, components, edge_entities, scm, num_threads):
+    # Attribute values and adjacency edges stay in shared memory, every worker only maps them
+    torch.set_num_threads(num_threads)
+    handles = {key: shared_memory.SharedMemory(name = name) for key, (name, _, _) in shared.items()}
+    arrays = {key: np.ndarray(shape, dtype = np.dtype(dtype), buffer = handles[key].buf) for key, (_, shape, dtype) in shared.items()}
+    _worker_state.update(
+        handles = handles,
+        attribute_values = {key: arrays[key] for key in shared if key[0] != "edges"},
+        edges = {relation: (row_entity, col_entity, arrays[("edges", relation, "rows")], arrays[("edges", relation, "cols")])
+                 for relation, (row_entity, col_entity) in edge_entities.items()},
+        schema = schema, structure = structure, components = components, scm = scm
+    )
+
+def _replicate_effect(picks: np.ndarray, treatment: RelationalNode, outcome: RelationalNode, warm_training_iter: int,
+                      treatment_value: float, control_value: float) -> float:
+    state = _worker_state
+    skeleton, adj_mat_dict = create_replicate(state["schema"], state["components"], state["edges"], picks, state["attribute_values"])
+    # Kernels of the replicate start from the fit on the original skeleton
+    scm = fit_relational_scm(RelationalSCM(state["structure"]), skeleton, adj_mat_dict, previous_scm = state["scm"],
+                             warm_training_iter = warm_training_iter)
+    return _average_effect(scm, skeleton, adj_mat_dict, treatment, outcome, treatment_value, control_value)
+
+def _average_effect(scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict, treatment: RelationalNode, outcome: RelationalNode,
+                    treatment_value: float, control_value: float) -> float:
+    names = skeleton.entity_instances[treatment.entity]["names"]
+    treatments = [InstanceNode(treatment.entity, treatment.attribute, name) for name in names]
+    outcomes = [InstanceNode(outcome.entity, outcome.attribute, name) for name in names]
+    effect = batch_effect_estimation(scm, skeleton, adj_mat_dict, treatments, outcomes, treatment_value, control_value,
+                                     paired = True, average = True)
+    return float(effect)
+
+@instrument.instrumented("bootstrap.effects")
+def bootstrap_effects(structure: RelationalCausalStructure, skeleton: RelationalSkeleton, treatment: RelationalNode, outcome: RelationalNode,
+                      num_replicates: int = 100, alpha: float = 0.05, treatment_value: float = 1., control_value: float = 0.,
+                      training_iter: int = 50, warm_training_iter: int = 10, max_workers: int = None, threads_per_worker: int = 1,
+                      seed: int = 0) -> dict:
+    """ Bootstrap interval for the average effect of a treatment attribute on an outcome attribute of the same entity
+
+    The SCM is fitted once on the original skeleton, which gives the point estimate. Replicates resample the connected
+    components of the skeleton with replacement, e.g. states with all of their towns and businesses, warm-start every
+    node GP from that fit and compute the paired ATE with batch_effect_estimation.
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): contains all instances
+        treatment (RelationalNode): treated attribute
+        outcome (RelationalNode): outcome attribute, of the same entity as the treatment
+        num_replicates (int, optional): number of bootstrap replicates. Defaults to 100.
+        alpha (float, optional): the interval covers 1 - alpha. Defaults to 0.05.
+        treatment_value (float, optional): value under treatment. Defaults to 1.
+        control_value (float, optional): value under control. Defaults to 0.
+        training_iter (int, optional): number of optimizer steps per node on the original skeleton. Defaults to 50.
+        warm_training_iter (int, optional): number of optimizer steps per node in every replicate. Defaults to 10.
+        max_workers (int, optional): number of worker processes, or 0 to run in this process. Defaults to the number of CPUs.
+        threads_per_worker (int, optional): torch threads in each worker. Defaults to 1.
+        seed (int, optional): seed of the resampling. Defaults to 0.
+
+    Returns:
+        dict: contains the 'estimate' on the original skeleton, the 'replicates', their 'std'
+              and the percentile 'interval' as a (lower, upper) tuple
+    """
+    if treatment.entity != outcome.entity:
+        print("Bootstrap effects need the treatment and outcome to be attributes of the same entity")
+        return None
+    schema = structure.schema
+    adj_mat_dict = create_adj_mat_dict(structure, skeleton)
+    scm = fit_relational_scm(RelationalSCM(structure), skeleton, adj_mat_dict, training_iter = training_iter)
+    estimate = _average_effect(scm, skeleton, adj_mat_dict, treatment, outcome, treatment_value, control_value)
+    # Replicates only need the hyperparameters and optimizer state, not the posterior factors of the original data
+    for model in scm.functions.values():
+        if model is not None:
+            model.clear_posterior_cache()
+
+    components, edges = get_component_data(structure, skeleton, find_components(schema, skeleton, adj_mat_dict))
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(len(components), size = (num_replicates, len(components)))
+    args = (treatment, outcome, warm_training_iter, treatment_value, control_value)
+
+    # Attribute values and adjacency edges of all instances in shared memory
+    arrays = {(entity, attribute): np.asarray(skeleton.entity_instances[entity][attribute], dtype = np.float64)
+              for entity, attributes in schema.attribute_classes.items() for attribute in attributes}
+    for relation, (_, _, rows, cols) in edges.items():
+        arrays[("edges", relation, "rows")] = rows
+        arrays[("edges", relation, "cols")] = cols
+    edge_entities = {relation: (row_entity, col_entity) for relation, (row_entity, col_entity, _, _) in edges.items()}
+    handles = {}
+    try:
+        handles, shared = _share_arrays(arrays)
+        initargs = (shared, schema, structure, components, edge_entities, scm, threads_per_worker)
+        if max_workers == 0:
+            previous_threads = torch.get_num_threads()
+            _init_worker(*initargs)
+            torch.set_num_threads(previous_threads)
+            try:
+                effects = [_replicate_effect(p, *args) for p in picks]
+            finally:
+                for handle in _worker_state["handles"].values():
+                    handle.close()
+                _worker_state.clear()
+        else:
+            with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_worker, initargs = initargs) as pool:
+                futures = [pool.submit(_replicate_effect, p, *args) for p in picks]
+                effects = [future.result() for future in futures]
+    finally:
+        for handle in handles.values():
+            handle.close()
+            handle.unlink()
+
+    instrument.count("bootstrap.replicates", num_replicates)
+    replicates = np.array(effects)
+    lower, upper = np.quantile(replicates, [alpha / 2, 1 - alpha / 2])
+    return {"estimate": estimate, "replicates": replicates, "std": float(replicates.std(ddof = 1)), "interval": (float(lower), float(upper))}
@@ -0,0 +1,187 @@
+import gc
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+# Import classes and functions for relational models
+from relational import *
+import instrument
+
+def _hash_json(content) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps(content, sort_keys = True, default = list).encode())
+    return digest.hexdigest()
+
+def structure_fingerprint(structure: RelationalCausalStructure) -> str:
+    """ Content hash of the schema and causal structure
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+
+    Returns:
+        str: hex digest that changes whenever the schema or the edges change
+    """
+    schema = structure.schema
+    return _hash_json({
+        "schema": [schema.entity_classes, schema.relationship_classes, schema.attribute_classes, schema.cardinality, schema.relations],
+        "structure": structure.edges
+    })
+
+def fingerprint(structure: RelationalCausalStructure, skeleton: RelationalSkeleton) -> str:
+    """ Content hash of the schema, skeleton and causal structure
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): contains all instances
+
+    Returns:
+        str: hex digest that changes whenever any of the three changes
+    """
+    schema = structure.schema
+    content = {
+        "schema": [schema.entity_classes, schema.relationship_classes, schema.attribute_classes, schema.cardinality, schema.relations],
+        "skeleton": [skeleton.entity_instances, skeleton.relationship_instances],
+        "structure": structure.edges
+    }
+    return _hash_json(content)
+
+class GraphCache:
+    """
+    On-disk cache of adjacency matrices and ground graphs, keyed by the fingerprint of the dataset.
+    Arrays are stored as .npy files and memory-mapped on load, and the least recently used entries
+    are evicted once the cache is larger than max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = '.relational_cache', max_bytes: int = 2 ** 30) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _entry_path(self, key: str, kind: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}_{kind}")
+
+    def _load(self, path: str):
+        if not os.path.isdir(path):
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode = 'r') for name in index["arrays"]}
+        return index, arrays
+
+    def _store(self, path: str, index: dict, arrays: dict, objects: dict = None):
+        # Write to a temporary directory first so that readers never see a partial entry
+        tmp_path = tempfile.mkdtemp(dir = self.cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+        for name, obj in (objects or {}).items():
+            with open(os.path.join(tmp_path, f"{name}.pkl"), 'wb') as f:
+                pickle.dump(obj, f, protocol = pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+            json.dump({**index, "arrays": list(arrays)}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors = True)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+    @instrument.instrumented("cache.adjacency")
+    def get_adj_mat_dict(self, structure: RelationalCausalStructure, skeleton: RelationalSkeleton, key: str = None) -> dict:
+        """ Cached version of create_adj_mat_dict
+
+        Args:
+            structure (RelationalCausalStructure): contains schema and edges
+            skeleton (RelationalSkeleton): contains all instances
+            key (str, optional): precomputed fingerprint. Defaults to None.
+
+        Returns:
+            dict: contains a read-only adjacency matrix (pd.DataFrame) for each relationship class
+        """
+        key = fingerprint(structure, skeleton) if key is None else key
+        path = self._entry_path(key, 'adjacency')
+        entry = self._load(path)
+        if entry is None:
+            instrument.count("cache.misses")
+            adj_mat_dict = create_adj_mat_dict(structure, skeleton)
+            index = {relation: [list(adj_mat.index), list(adj_mat.columns)] for relation, adj_mat in adj_mat_dict.items()}
+            arrays = {f"adj_{i}": adj_mat.to_numpy(dtype = bool) for i, adj_mat in enumerate(adj_mat_dict.values())}
+            self._store(path, {"relations": index}, arrays)
+            return adj_mat_dict
+        instrument.count("cache.hits")
+        index, arrays = entry
+        adj_mat_dict = {}
+        for i, (relation, (rows, cols)) in enumerate(index["relations"].items()):
+            adj_mat_dict[relation] = pd.DataFrame(arrays[f"adj_{i}"], index = rows, columns = cols, copy = False)
+        return adj_mat_dict
+
+    @instrument.instrumented("cache.ground_graph")
+    def get_ground_graph(self, structure: RelationalCausalStructure, skeleton: RelationalSkeleton, key: str = None, 
+                         as_arrays: bool = False):
+        """ Cached version of create_ground_graph
+
+        The graph is stored pickled, which loads much faster than rebuilding it edge by edge,
+        next to memory-mapped node and edge arrays for callers that do not need a networkx graph.
+
+        Args:
+            structure (RelationalCausalStructure): contains schema and edges
+            skeleton (RelationalSkeleton): contains all instances
+            key (str, optional): precomputed fingerprint. Defaults to None.
+            as_arrays (bool, optional): return the node names, node values and edges as arrays. Defaults to False.
+
+        Returns:
+            nx.DiGraph: the abstract ground graph, or with as_arrays a (node names, values, edges) tuple,
+                        where edges is an (num_edges, 2) array of node positions
+        """
+        key = fingerprint(structure, skeleton) if key is None else key
+        path = self._entry_path(key, 'ground_graph')
+        entry = self._load(path)
+        if entry is None:
+            instrument.count("cache.misses")
+            ground_graph = create_ground_graph(structure, skeleton)
+            nodes = list(ground_graph.nodes)
+            node_index = {node: i for i, node in enumerate(nodes)}
+            values = np.array([ground_graph.nodes[node]["val"] for node in nodes], dtype = float)
+            edges = np.array([[node_index[u], node_index[v]] for u, v in ground_graph.edges], dtype = np.int64).reshape(-1, 2)
+            self._store(path, {"nodes": nodes}, {"values": values, "edges": edges}, {"graph": ground_graph})
+            return (nodes, values, edges) if as_arrays else ground_graph
+        instrument.count("cache.hits")
+        index, arrays = entry
+        if as_arrays:
+            return index["nodes"], arrays["values"], arrays["edges"]
+        # Unpickling creates one dict per node and edge, which would otherwise trigger many garbage collections
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(os.path.join(path, 'graph.pkl'), 'rb') as f:
+                return pickle.load(f)
+        finally:
+            if gc_enabled:
+                gc.enable()
@@ -0,0 +1,111 @@
+import json
+import os
+import numpy as np
+import torch
+import gpytorch
+
+# Import classes and functions for relational models
+from relational import *
+from model import NodeGPModel, SolverSettings
+from policy import ComputePolicy
+from cache import structure_fingerprint
+import instrument
+
+def get_node_key(node: RelationalNode) -> str:
+    return '.'.join([node.entity, node.attribute])
+
+def _save_array(path: str, name: str, tensor: torch.Tensor) -> str:
+    np.save(os.path.join(path, f"{name}.npy"), tensor.detach().cpu().numpy())
+    return name
+
+def _load_array(path: str, name: str, mmap: bool) -> torch.Tensor:
+    # Copy-on-write mapping keeps the arrays on disk until they are read, and writable for torch
+    return torch.from_numpy(np.load(os.path.join(path, f"{name}.npy"), mmap_mode = 'c' if mmap else None))
+
+@instrument.instrumented("checkpoint.save")
+def save_scm(scm: RelationalSCM, path: str):
+    """ Save the fitted node GPs of an SCM, with their hyperparameters, training data and posterior factors
+
+    Args:
+        scm (RelationalSCM): SCM whose functions are NodeGPModels, or None for unmodelled nodes
+        path (str): directory of the checkpoint
+    """
+    os.makedirs(path, exist_ok = True)
+    manifest = {"fingerprint": structure_fingerprint(scm.structure), "nodes": {}}
+    for node, model in scm.functions.items():
+        if model is None:
+            continue
+        key = get_node_key(node)
+        if model.posterior_alpha is None:
+            model.compute_posterior_cache()
+        arrays = {
+            "train_x": _save_array(path, f"{key}.train_x", model.train_inputs[0]),
+            "train_y": _save_array(path, f"{key}.train_y", model.train_targets),
+            "alpha": _save_array(path, f"{key}.alpha", model.posterior_alpha)
+        }
+        if model.train_index is not None:
+            arrays["train_index"] = _save_array(path, f"{key}.train_index", model.train_index)
+        if model.group_index is not None:
+            arrays["group_index"] = _save_array(path, f"{key}.group_index", model.group_index)
+        if model.posterior_chol is not None:
+            arrays["chol"] = _save_array(path, f"{key}.chol", model.posterior_chol)
+        optimizer_file = None
+        if model.optimizer_state is not None:
+            optimizer_file = f"{key}.optimizer.pt"
+            torch.save(model.optimizer_state, os.path.join(path, optimizer_file))
+        params = {name: _save_array(path, f"{key}.param.{name}", value) for name, value in model.state_dict().items()}
+        manifest["nodes"][key] = {
+            "parents": [[relation, parent.entity, parent.attribute, edge_type] for (relation, parent), edge_type in model.parents.items()],
+            "solver": model.solver._asdict(),
+            "kernel_backend": model.kernel_backend,
+            "tile_size": model.tile_size,
+            "policy": model.policy._asdict(),
+            "data_hash": model.data_hash,
+            "optimizer": optimizer_file,
+            "arrays": arrays,
+            "params": params
+        }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent = 4)
+
+@instrument.instrumented("checkpoint.load")
+def load_scm(structure: RelationalCausalStructure, path: str, mmap: bool = True) -> RelationalSCM:
+    """ Load a fitted SCM saved with save_scm, ready for predictions without refitting
+
+    Args:
+        structure (RelationalCausalStructure): causal structure, which must match the one the SCM was fitted for
+        path (str): directory of the checkpoint
+        mmap (bool, optional): memory-map the training data and posterior factors. Defaults to True.
+
+    Returns:
+        RelationalSCM: the fitted SCM, or an unfitted one if the checkpoint does not match the structure
+    """
+    scm = RelationalSCM(structure)
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    if manifest["fingerprint"] != structure_fingerprint(structure):
+        print("Checkpoint was saved for a different schema or structure, could not load from file")
+        return scm
+
+    for node in scm.functions:
+        key = get_node_key(node)
+        if key not in manifest["nodes"]:
+            continue
+        info = manifest["nodes"][key]
+        arrays = {name: _load_array(path, filename, mmap) for name, filename in info["arrays"].items()}
+        parents = {(relation, RelationalNode(entity, attribute)): edge_type for relation, entity, attribute, edge_type in info["parents"]}
+        policy = ComputePolicy(**info["policy"]) if "policy" in info else None
+        model = NodeGPModel(arrays["train_x"], arrays["train_y"], gpytorch.likelihoods.GaussianLikelihood(), parents,
+                            SolverSettings(**info["solver"]), info["kernel_backend"], info["tile_size"], policy,
+                            arrays.get("group_index"), info["data_hash"])
+        model = model.to(arrays["train_x"].dtype)
+        model.load_state_dict({name: _load_array(path, filename, False) for name, filename in info["params"].items()})
+        model.eval()
+        model.likelihood.eval()
+        model.train_index = arrays.get("train_index")
+        model.posterior_alpha = arrays["alpha"]
+        model.posterior_chol = arrays.get("chol")
+        if info.get("optimizer") is not None:
+            model.optimizer_state = torch.load(os.path.join(path, info["optimizer"]))
+        scm.functions[node] = model
+    return scm
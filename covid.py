@@ -81,6 +81,49 @@ class CovidData:
         self.business_names = [business for _, state in self.relational_skeleton.items() for _, town in state.items() for business in town]
         self.instance_names = self.state_names + self.town_names + self.business_names
 
+    def to_relational_dicts(self):
+        """ Convert the dataset to the formats read by RelationalSchema, RelationalSkeleton and RelationalCausalStructure
+
+        Returns:
+            Tuple[dict, dict, dict]: schema, skeleton and causal structure dicts
+        """
+        schema = {
+            'entity_classes': list(self.entities.keys()),
+            'relationship_classes': list(self.relations.keys()),
+            'attribute_classes': self.entities,
+            'cardinality': {relation: {info['from']: 'one', info['to']: 'many'} for relation, info in self.relations.items()},
+            'relations': {relation: [info['from'], info['to']] for relation, info in self.relations.items()}
+        }
+
+        skeleton = {
+            'entity_instances': {
+                'state': {'names': self.state_names, **self.states},
+                'town': {'names': self.town_names, **self.towns},
+                'business': {'names': self.business_names, **self.businesses}
+            },
+            'relationship_instances': {
+                'contains': [[state, town] for state, towns in self.relational_skeleton.items() for town in towns],
+                'resides': [[town, business] for _, towns in self.relational_skeleton.items() 
+                                             for town, businesses in towns.items() for business in businesses]
+            }
+        }
+
+        structure = {relation: [[list(edge['from']), list(edge['to'])] for edge in edges] 
+                     for relation, edges in self.causal_edges.items()}
+        return schema, skeleton, structure
+
+    def write_relational_files(self, data_dir = 'data/covid/'):
+        
+        if not os.path.isdir(data_dir):
+            os.mkdir(data_dir)
+
+        paths = {}
+        for name, content in zip(['schema', 'skeleton', 'structure'], self.to_relational_dicts()):
+            paths[name] = os.path.join(data_dir, f"relational_{name}.json")
+            with open(paths[name], 'w') as f:
+                json.dump(content, f)
+        return paths
+
     def relational_skeleton_to_adj_matrix(self, return_type = 'dataframe'):
         
         # Extract adjacency matrices
@@ -140,9 +183,14 @@ class CovidData:
     def generate_data(self):
         self.reset()
 
+        # Zero-pad indices so that instance names stay unique with more than 10 instances per level
+        state_width = len(str(self.num_states - 1))
+        town_width = len(str(self.num_towns_per_state - 1))
+        business_width = len(str(self.num_businesses_per_town - 1))
+
         for i in range(self.num_states):
             # Sample state policy
-            state_name = f"s{i}"
+            state_name = f"s{i:0{state_width}d}"
             self.relational_skeleton[state_name] = {}
             state_policy = np.random.normal(0, 0.5)
             self.states['policy'].append(state_policy)
@@ -150,7 +198,7 @@ class CovidData:
             for j in range(self.num_towns_per_state):
 
                 # Sample town policy per state
-                town_name = f"t{i}{j}"
+                town_name = f"t{i:0{state_width}d}{j:0{town_width}d}"
                 self.relational_skeleton[state_name][town_name] = []
                 town_policy = state_policy + np.random.normal(0, 0.2)
                 self.towns['policy'].append(town_policy)
@@ -158,7 +206,7 @@ class CovidData:
                 num_businesses_per_town = np.random.poisson(np.abs(town_policy)) + 1
                 for k in range(self.num_businesses_per_town):
                     # Sample business occupancy per town
-                    business_name = f"b{i}{j}{k}"
+                    business_name = f"b{i:0{state_width}d}{j:0{town_width}d}{k:0{business_width}d}"
                     self.relational_skeleton[state_name][town_name].append(business_name)
                     business_occupancy = town_policy + np.random.normal(0, 0.5)
                     self.businesses['occupancy'].append(business_occupancy)
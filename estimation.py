@@ -2,11 +2,16 @@ import torch
 import gpytorch
 import pyro
 import typing
+from collections import namedtuple
 from relational import *
+from model import get_edge_type, get_relation_matrix, get_skeleton_values
+from policy import get_dtype
+import instrument
 
 def causal_estimand(y, y_t):
     pass
 
+@instrument.instrumented("estimation.effect")
 def gaussian_process_effect_estimation(scm: RelationalSCM, num_samples: int, input_data: dict, intervention: dict) -> float:
     
     """Obtain samples from the posterior over causal effects
@@ -25,6 +30,7 @@ def gaussian_process_effect_estimation(scm: RelationalSCM, num_samples: int, inp
     for i in range(num_samples):
         # Initialize dict for storing counterfactual outcomes
         intervention_assignment = {}
+        instrument.count("estimation.mc_samples")
         for var in scm.topological_ordering:
             if var in intervention:
                 # If the variable has been intervened on, then set the value of the attribute to the intervened value
@@ -45,3 +51,248 @@ def gaussian_process_effect_estimation(scm: RelationalSCM, num_samples: int, inp
     # Return MC estimate for causal effect
     causal_effect /= num_samples
     return causal_effect
+
+def get_parent_maps(structure: RelationalCausalStructure, adj_mat_dict: dict, node: RelationalNode, dtype: torch.dtype = None) -> list:
+    """ Maps from the values of every parent to the GP input columns of a node, in the column order of get_node_data
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        node (RelationalNode): child node
+        dtype (torch.dtype, optional): dtype of the maps. Defaults to the dtype of the global compute policy.
+
+    Returns:
+        list: (parent RelationalNode, map) tuples, where the map is None for self edges and otherwise a sparse
+              (num_instances, num_parent_instances) matrix averaging over the related parent instances
+    """
+    parent_maps = []
+    for relation, edge in structure.get_incoming_edges(node.entity, node.attribute):
+        if get_edge_type(structure, relation, edge.parent.entity, node.entity) == 'self':
+            parent_maps.append((edge.parent, None))
+            continue
+        relation_matrix = get_relation_matrix(structure, adj_mat_dict, relation, edge.parent.entity, node.entity, dtype)
+        counts = relation_matrix.sum(dim = 1, keepdim = True).clamp(min = 1)
+        parent_maps.append((edge.parent, (relation_matrix / counts).to_sparse()))
+    return parent_maps
+
+def get_batch_inputs(parent_maps: list, values: dict, dtype: torch.dtype = None) -> torch.Tensor:
+    """ GP inputs of a node for a batch of parent values
+
+    Args:
+        parent_maps (list): output of get_parent_maps
+        values (dict): key is a RelationalNode and value is a (batch_size, num_instances) tensor
+        dtype (torch.dtype, optional): dtype of the inputs. Defaults to the dtype of the global compute policy.
+
+    Returns:
+        torch.Tensor: inputs of shape (batch_size, num_instances, num_parents)
+    """
+    dtype = get_dtype() if dtype is None else dtype
+    columns = []
+    for parent, parent_map in parent_maps:
+        parent_values = values[parent].to(dtype)
+        columns.append(parent_values if parent_map is None else torch.sparse.mm(parent_map, parent_values.T).T)
+    return torch.stack(columns, dim = -1)
+
+# Everything a counterfactual sweep needs that only depends on the fitted SCM and the skeleton
+# values holds the observed values of every node in the global dtype, parent_maps the get_parent_maps of every
+# modelled node, factual_means the posterior mean of every modelled node at the observed parent values
+# and instance_index the position of every instance name of every entity
+SweepState = namedtuple('SweepState', 'values parent_maps factual_means instance_index')
+
+@instrument.instrumented("estimation.prepare_sweep")
+def prepare_sweep(scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict) -> SweepState:
+    """ Precompute the observed values, parent maps and factual posterior means used by every sweep
+
+    The state is only valid for the SCM as it is fitted now, and has to be prepared again after a refit.
+
+    Args:
+        scm (RelationalSCM): fitted SCM
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+
+    Returns:
+        SweepState: state to pass to counterfactual_sweep and batch_effect_estimation
+    """
+    values = get_skeleton_values(scm.structure, skeleton)
+    parent_maps = {}
+    factual_means = {}
+    for node, model in scm.functions.items():
+        if model is None:
+            continue
+        model_dtype = model.train_inputs[0].dtype
+        parent_maps[node] = get_parent_maps(scm.structure, adj_mat_dict, node, model_dtype)
+        factual_inputs = get_batch_inputs(parent_maps[node], {parent: values[parent].unsqueeze(0) for parent, _ in parent_maps[node]}, model_dtype)
+        factual_means[node] = model.predict_mean(factual_inputs)[0]
+    instance_index = {entity: dict(zip(instances["names"], range(len(instances["names"]))))
+                      for entity, instances in skeleton.entity_instances.items()}
+    return SweepState(values, parent_maps, factual_means, instance_index)
+
+def get_affected(parent_maps: list, changed: dict) -> torch.Tensor:
+    """ Instances of a node with at least one changed parent value in each row of a batch
+
+    Args:
+        parent_maps (list): output of get_parent_maps
+        changed (dict): key is a RelationalNode and value is a (batch_size, num_instances) boolean mask of changed values
+
+    Returns:
+        torch.Tensor: (batch_size, num_instances) boolean mask, or None if no parent changed
+    """
+    affected = None
+    for parent, parent_map in parent_maps:
+        if parent not in changed:
+            continue
+        if parent_map is None:
+            parent_affected = changed[parent]
+        else:
+            parent_affected = torch.sparse.mm(parent_map, changed[parent].T.to(parent_map.dtype)).T != 0
+        affected = parent_affected if affected is None else affected | parent_affected
+    return affected
+
+@instrument.instrumented("estimation.counterfactual_sweep")
+def counterfactual_sweep(scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict, 
+                         interventions: dict, state: SweepState = None) -> dict:
+    """ Counterfactual values of every node under a batch of interventions, in a single pass over the SCM
+
+    Noise is abducted from the observed data assuming it is additive, so every counterfactual value is the observed
+    value plus the change in the posterior mean of its node function. Each row only evaluates the node GPs at the
+    instances that descend from its intervened instances in the ground graph, all other instances keep their
+    observed values, so the GP cost grows with the size of the affected subgraphs and not with the number of rows
+    times the number of instances.
+
+    Args:
+        scm (RelationalSCM): fitted SCM
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        interventions (dict): key is a RelationalNode and value is a (mask, value) tuple of (batch_size, num_instances)
+                              tensors, the mask is True for every intervened instance in each row of the batch
+        state (SweepState, optional): output of prepare_sweep for this SCM and skeleton. Defaults to preparing it.
+
+    Returns:
+        dict: key is a RelationalNode and value is a (batch_size, num_instances) tensor of counterfactual values
+    """
+    state = prepare_sweep(scm, skeleton, adj_mat_dict) if state is None else state
+    batch_size = max(mask.shape[0] for mask, _ in interventions.values())
+    dtype = get_dtype()
+    counterfactuals = {}
+    changed = {} # key is a RelationalNode and value is the mask of instances whose value changed in each row
+    for node in scm.topological_ordering:
+        observed = state.values[node].to(dtype)
+        counterfactual = observed.expand(batch_size, -1)
+        model = scm.functions.get(node)
+        affected = get_affected(state.parent_maps[node], changed) if model is not None else None
+        if affected is not None and affected.any():
+            # Inputs follow the compute policy of the node model, and are only evaluated where a parent changed
+            model_dtype = model.train_inputs[0].dtype
+            rows, instances = affected.nonzero(as_tuple = True)
+            inputs = get_batch_inputs(state.parent_maps[node], counterfactuals, model_dtype)[rows, instances]
+            shift = model.predict_mean(inputs) - state.factual_means[node][instances]
+            counterfactual = counterfactual.clone()
+            counterfactual[rows, instances] = observed[instances] + shift.to(dtype)
+            instrument.count("estimation.node_sweeps")
+            instrument.count("estimation.affected_instances", len(rows))
+            changed[node] = affected
+        if node in interventions:
+            mask, value = interventions[node]
+            counterfactual = torch.where(mask, torch.as_tensor(value, dtype = counterfactual.dtype), counterfactual)
+            changed[node] = mask if node not in changed else changed[node] | mask
+        counterfactuals[node] = counterfactual
+    return counterfactuals
+
+def get_instance_positions(skeleton: RelationalSkeleton, instances: list, instance_index: dict = None) -> typing.Tuple[list, torch.Tensor]:
+    """ Node and position in the attribute vector of every instance node
+
+    Args:
+        skeleton (RelationalSkeleton): contains all instances
+        instances (list): InstanceNodes
+        instance_index (dict, optional): position of every instance name of every entity, e.g. from a SweepState. 
+                                         Defaults to building it from the skeleton.
+
+    Returns:
+        Tuple[list, torch.Tensor]: RelationalNode of every instance node and their positions
+    """
+    instance_index = {} if instance_index is None else instance_index
+    nodes = []
+    positions = []
+    for instance in instances:
+        if instance.entity not in instance_index:
+            names = skeleton.entity_instances[instance.entity]["names"]
+            instance_index[instance.entity] = dict(zip(names, range(len(names))))
+        nodes.append(RelationalNode(instance.entity, instance.attribute))
+        positions.append(instance_index[instance.entity][instance.instance])
+    return nodes, torch.tensor(positions, dtype = torch.long)
+
+@instrument.instrumented("estimation.batch_effects")
+def batch_effect_estimation(scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict, 
+                            treatments: list, outcomes: list, treatment_value: float = 1., control_value: float = 0.,
+                            paired: bool = False, average: bool = False, batch_size: int = None, state: SweepState = None) -> torch.Tensor:
+    """ Individual effects of every treatment instance on every outcome instance
+
+    Row i of the batch sets treatment instance i to the treatment and to the control value while all other
+    instances keep their observed values, and all rows go through one counterfactual sweep.
+
+    Args:
+        scm (RelationalSCM): fitted SCM
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        treatments (list): InstanceNodes that are intervened on, one at a time
+        outcomes (list): InstanceNodes whose effects are returned
+        treatment_value (float, optional): value under treatment. Defaults to 1.
+        control_value (float, optional): value under control. Defaults to 0.
+        paired (bool, optional): only return the effect of the i-th treatment on the i-th outcome. Defaults to False.
+        average (bool, optional): average the effects over the treatment instances. Defaults to False.
+        batch_size (int, optional): treatment instances per sweep, to bound memory. Defaults to all of them.
+        state (SweepState, optional): output of prepare_sweep, to share between calls. Defaults to preparing it.
+
+    Returns:
+        torch.Tensor: effects of shape (num_treatments, num_outcomes), or (num_treatments,) if paired.
+                      With average, the mean over treatments, which is the ATE for paired effects.
+    """
+    if paired and len(treatments) != len(outcomes):
+        print("Paired effects need as many outcome instances as treatment instances")
+        return None
+    state = prepare_sweep(scm, skeleton, adj_mat_dict) if state is None else state
+    values = state.values
+    treatment_nodes, treatment_positions = get_instance_positions(skeleton, treatments, state.instance_index)
+    outcome_nodes, outcome_positions = get_instance_positions(skeleton, outcomes, state.instance_index)
+    num_treatments = len(treatments)
+    batch_size = num_treatments if batch_size is None else batch_size
+
+    effects = []
+    for start in range(0, num_treatments, batch_size):
+        rows = torch.arange(start, min(start + batch_size, num_treatments))
+        num_rows = len(rows)
+        # Treated rows come first and control rows second
+        interventions = {}
+        for node in set(treatment_nodes[i] for i in rows.tolist()):
+            in_node = torch.tensor([treatment_nodes[i] == node for i in rows.tolist()])
+            batch_rows = torch.arange(num_rows)[in_node]
+            mask = torch.zeros(2 * num_rows, len(values[node]), dtype = torch.bool)
+            value = torch.zeros(2 * num_rows, len(values[node]), dtype = get_dtype())
+            positions = treatment_positions[rows[in_node]]
+            mask[batch_rows, positions] = True
+            mask[batch_rows + num_rows, positions] = True
+            value[batch_rows, positions] = treatment_value
+            value[batch_rows + num_rows, positions] = control_value
+            interventions[node] = (mask, value)
+        counterfactuals = counterfactual_sweep(scm, skeleton, adj_mat_dict, interventions, state)
+        # Attributes outside the causal structure are not affected by any intervention
+        for node in set(outcome_nodes) - set(counterfactuals):
+            counterfactuals[node] = values[node].to(get_dtype()).expand(2 * num_rows, -1)
+
+        if paired:
+            chunk = torch.zeros(num_rows, dtype = get_dtype())
+            for node in set(outcome_nodes[i] for i in rows.tolist()):
+                in_node = torch.tensor([outcome_nodes[i] == node for i in rows.tolist()])
+                batch_rows = torch.arange(num_rows)[in_node]
+                positions = outcome_positions[rows[in_node]]
+                outcome_values = counterfactuals[node]
+                chunk[batch_rows] = outcome_values[batch_rows, positions] - outcome_values[batch_rows + num_rows, positions]
+        else:
+            chunk = torch.zeros(num_rows, len(outcomes), dtype = get_dtype())
+            for node in set(outcome_nodes):
+                columns = torch.tensor([i for i, outcome_node in enumerate(outcome_nodes) if outcome_node == node], dtype = torch.long)
+                outcome_values = counterfactuals[node][:, outcome_positions[columns]]
+                chunk[:, columns] = outcome_values[:num_rows] - outcome_values[num_rows:]
+        effects.append(chunk)
+    effects = torch.cat(effects)
+    return effects.mean(dim = 0) if average else effects
@@ -1,5 +1,6 @@
 from typing import *
 import torch
+import numpy as np
 import gpytorch
 
 # Import classes and functions for relational models
@@ -0,0 +1,162 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+class _State:
+    """
+    Global instrumentation state, everything is a no-op until enable() is called
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stats = {} # each key is a stage name and value is a dict of timings and memory
+        self.counters = {} # each key is a counter name and value is a count
+        self.events = [] # completed stages in Chrome trace event format
+        self.active = [] # stages that are currently running, innermost last
+        self.origin = time.perf_counter()
+
+_state = _State()
+_lock = threading.Lock()
+_sampler = None
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak instead of current RSS on systems without procfs
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _MemorySampler(threading.Thread):
+    """
+    Samples the resident memory in the background and records the peak of every active stage
+    """
+    def __init__(self, interval: float) -> None:
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            with _lock:
+                for name in _state.active:
+                    stats = _state.stats.get(name)
+                    if stats is not None:
+                        stats['peak_rss_bytes'] = max(stats.get('peak_rss_bytes', 0), rss)
+
+def enable(sample_memory: bool = False, interval: float = 0.01):
+    """ Start collecting timings and counters
+
+    Args:
+        sample_memory (bool, optional): sample the resident memory in a background thread. Defaults to False.
+        interval (float, optional): seconds between memory samples. Defaults to 0.01.
+    """
+    global _sampler
+    _state.enabled = True
+    if sample_memory and _sampler is None:
+        _sampler = _MemorySampler(interval)
+        _sampler.start()
+
+def disable():
+    global _sampler
+    _state.enabled = False
+    if _sampler is not None:
+        _sampler.stopped.set()
+        _sampler = None
+
+def reset():
+    with _lock:
+        _state.reset()
+
+def is_enabled() -> bool:
+    return _state.enabled
+
+@contextmanager
+def timer(name: str):
+    """ Time the enclosed block as a stage
+
+    Args:
+        name (str): stage name, repeated stages are aggregated
+    """
+    if not _state.enabled:
+        yield
+        return
+    with _lock:
+        stats = _state.stats.setdefault(name, {'calls': 0, 'total_seconds': 0., 'max_seconds': 0.})
+        _state.active.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _state.active.remove(name)
+            stats['calls'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            _state.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                  'ts': (start - _state.origin) * 1e6, 'dur': elapsed * 1e6})
+
+def count(name: str, n: int = 1):
+    """ Increment a counter, e.g. for kernel evaluations or solves
+
+    Args:
+        name (str): counter name
+        n (int, optional): increment. Defaults to 1.
+    """
+    if not _state.enabled:
+        return
+    with _lock:
+        _state.counters[name] = _state.counters.get(name, 0) + n
+
+def instrumented(name: str):
+    """ Decorator that times every call of a function as a stage
+
+    Args:
+        name (str): stage name
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return fn(*args, **kwargs)
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_stats() -> dict:
+    """ Per-stage timings and memory, and all counters
+
+    Returns:
+        dict: contains 'stages' and 'counters'
+    """
+    with _lock:
+        return {'stages': {name: dict(stats) for name, stats in _state.stats.items()},
+                'counters': dict(_state.counters)}
+
+def export_json(path: str):
+    with open(path, 'w') as f:
+        json.dump(get_stats(), f, indent = 4)
+
+def export_chrome_trace(path: str):
+    """ Write all completed stages as a trace that can be opened in chrome://tracing or Perfetto
+
+    Args:
+        path (str): output path
+    """
+    with _lock:
+        events = list(_state.events)
+        counters = dict(_state.counters)
+    end = (time.perf_counter() - _state.origin) * 1e6
+    events.extend({'name': name, 'ph': 'C', 'pid': os.getpid(), 'ts': end, 'args': {name: value}}
+                  for name, value in counters.items())
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,28 @@
+import importlib
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used,
+    so that importing lightweight code does not pay for heavy dependencies it may never need
+    """
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
@@ -0,0 +1,113 @@
+import torch
+import gpytorch
+from linear_operator.operators import LinearOperator
+import instrument
+
+def _rbf_block(x1, x2, lengthscale, outputscale):
+    # Product of RBF kernels over the input columns, i.e. an RBF kernel with one lengthscale per column
+    x1 = x1 / lengthscale
+    x2 = x2 / lengthscale
+    sq_dist = (x1 ** 2).sum(dim = -1, keepdim = True) - 2 * x1 @ x2.transpose(-1, -2) + (x2 ** 2).sum(dim = -1)
+    return outputscale * torch.exp(-0.5 * sq_dist.clamp_(min = 0))
+
+class TiledProductKernelOperator(LinearOperator):
+    """
+    Matrix-free product of RBF kernels over the columns of x1 and x2.
+    Kernel-vector products are computed in tiles of rows, so at most tile_size x m kernel
+    entries exist at any time and the full n x m Gram matrix is never stored.
+    """
+
+    def __init__(self, x1, x2, lengthscale, outputscale, tile_size = 1024):
+        super().__init__(x1, x2, lengthscale, outputscale, tile_size = tile_size)
+        self.x1 = x1
+        self.x2 = x2
+        self.lengthscale = lengthscale
+        self.outputscale = outputscale
+        self.tile_size = tile_size
+
+    def _size(self):
+        return torch.Size((self.x1.shape[-2], self.x2.shape[-2]))
+
+    def _transpose_nonbatch(self):
+        return TiledProductKernelOperator(self.x2, self.x1, self.lengthscale, self.outputscale, self.tile_size)
+
+    def _tiles(self):
+        for start in range(0, self.x1.shape[-2], self.tile_size):
+            yield slice(start, min(start + self.tile_size, self.x1.shape[-2]))
+
+    def _matmul(self, rhs):
+        is_vector = rhs.dim() == 1
+        rhs = rhs.unsqueeze(-1) if is_vector else rhs
+        instrument.count("gp.tiled_matvecs")
+        res = torch.empty(self.x1.shape[-2], rhs.shape[-1], dtype = rhs.dtype, device = rhs.device)
+        for tile in self._tiles():
+            res[tile] = _rbf_block(self.x1[tile], self.x2, self.lengthscale, self.outputscale) @ rhs
+        return res.squeeze(-1) if is_vector else res
+
+    def _bilinear_derivative(self, left_vecs, right_vecs):
+        # Accumulate the gradient of u^T K v tile by tile, so the autograd graph never holds more than one tile
+        args = (self.x1, self.x2, self.lengthscale, self.outputscale)
+        grads = [torch.zeros_like(arg) if arg.requires_grad else None for arg in args]
+        if left_vecs.dim() == 1:
+            left_vecs = left_vecs.unsqueeze(-1)
+            right_vecs = right_vecs.unsqueeze(-1)
+        with torch.enable_grad():
+            for tile in self._tiles():
+                block = _rbf_block(self.x1[tile], self.x2, self.lengthscale, self.outputscale)
+                loss = (left_vecs[tile] * (block @ right_vecs)).sum()
+                requires_grad = [arg for arg in args if arg.requires_grad]
+                tile_grads = iter(torch.autograd.grad(loss, requires_grad, allow_unused = True))
+                for i, arg in enumerate(args):
+                    if arg.requires_grad:
+                        tile_grad = next(tile_grads)
+                        if tile_grad is not None:
+                            grads[i] += tile_grad
+        return tuple(grads)
+
+    def _diagonal(self):
+        sq_dist = (((self.x1 - self.x2) / self.lengthscale) ** 2).sum(dim = -1)
+        return self.outputscale * torch.exp(-0.5 * sq_dist)
+
+    def _get_indices(self, row_index, col_index, *batch_indices):
+        sq_dist = (((self.x1[row_index] - self.x2[col_index]) / self.lengthscale) ** 2).sum(dim = -1)
+        return self.outputscale * torch.exp(-0.5 * sq_dist)
+
+    def _getitem(self, row_index, col_index, *batch_indices):
+        return TiledProductKernelOperator(self.x1[row_index], self.x2[col_index], 
+                                          self.lengthscale, self.outputscale, self.tile_size)
+
+    def to_dense(self):
+        return _rbf_block(self.x1, self.x2, self.lengthscale, self.outputscale)
+
+class TiledProductKernel(gpytorch.kernels.ScaleKernel):
+    """
+    Drop-in replacement for the scaled product of RBF kernels built by NodeGPModel.compose_kernels.
+    It holds the same parameters, but evaluates to a TiledProductKernelOperator instead of a dense Gram matrix.
+    Use it with iterative solves, since a Cholesky decomposition would materialize the matrix.
+    """
+
+    def __init__(self, base_kernel, tile_size = 1024, **kwargs):
+        super().__init__(base_kernel, **kwargs)
+        self.tile_size = tile_size
+
+    def _columns_and_lengthscale(self):
+        dims = []
+        lengthscales = []
+        for kernel in self.base_kernel.kernels:
+            dims.append(kernel.active_dims)
+            lengthscales.append(kernel.lengthscale.reshape(-1).expand(len(kernel.active_dims)))
+        return torch.cat(dims), torch.cat(lengthscales)
+
+    def forward(self, x1, x2, diag = False, **params):
+        dims, lengthscale = self._columns_and_lengthscale()
+        x1 = x1.index_select(-1, dims)
+        x2 = x2.index_select(-1, dims)
+        if diag:
+            sq_dist = (((x1 - x2) / lengthscale) ** 2).sum(dim = -1)
+            return self.outputscale * torch.exp(-0.5 * sq_dist)
+        return TiledProductKernelOperator(x1, x2, lengthscale, self.outputscale, self.tile_size)
+
+    def __call__(self, x1, x2 = None, diag = False, **params):
+        # Skip the component-wise active_dims handling of the parent class, forward selects the columns itself
+        x2 = x1 if x2 is None else x2
+        return self.forward(x1, x2, diag = diag, **params)
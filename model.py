@@ -1,74 +1,447 @@
 from typing import *
+import copy
+import hashlib
 import math
+from collections import namedtuple
+from contextlib import ExitStack
 import gpytorch
-import pyro
 import torch
-from pyro.infer.mcmc import NUTS, MCMC
-from matplotlib import pyplot as plt
 from relational import *
+from lazy_kernels import TiledProductKernel
+from structured import GroupedCovariance, get_node_groups
+from policy import ComputePolicy, get_dtype, get_policy, policy_context
+import instrument
+
+# Settings for the linear solves used by a node GP
+# mode is 'exact' (Cholesky), 'iterative' (preconditioned CG and stochastic Lanczos quadrature) 
+# or 'auto', which is exact up to max_exact_size training instances and iterative above that
+SolverSettings = namedtuple('SolverSettings', 'mode max_exact_size cg_tolerance max_cg_iterations preconditioner_size num_trace_samples max_lanczos_iterations',
+                            defaults = ('auto', 2000, 1e-2, 1000, 15, 10, 20))
+
+def uses_iterative_solver(settings: SolverSettings, num_data: int) -> bool:
+    return settings.mode == 'iterative' or (settings.mode == 'auto' and num_data > settings.max_exact_size)
+
+def solver_context(settings: SolverSettings, num_data: int) -> ExitStack:
+    """ Enter the gpytorch settings for the solver selected for a node
+
+    Args:
+        settings (SolverSettings): solver settings of the node
+        num_data (int): number of training instances of the node
+
+    Returns:
+        ExitStack: context manager holding all gpytorch settings
+    """
+    stack = ExitStack()
+    if uses_iterative_solver(settings, num_data):
+        # CG solves with a pivoted Cholesky preconditioner, log-determinants from stochastic Lanczos quadrature
+        stack.enter_context(gpytorch.settings.max_cholesky_size(0))
+        stack.enter_context(gpytorch.settings.fast_computations(covar_root_decomposition = True, log_prob = True, solves = True))
+        stack.enter_context(gpytorch.settings.cg_tolerance(settings.cg_tolerance))
+        stack.enter_context(gpytorch.settings.eval_cg_tolerance(settings.cg_tolerance))
+        stack.enter_context(gpytorch.settings.max_cg_iterations(settings.max_cg_iterations))
+        stack.enter_context(gpytorch.settings.max_preconditioner_size(settings.preconditioner_size))
+        stack.enter_context(gpytorch.settings.num_trace_samples(settings.num_trace_samples))
+        stack.enter_context(gpytorch.settings.max_lanczos_quadrature_iterations(settings.max_lanczos_iterations))
+    else:
+        stack.enter_context(gpytorch.settings.max_cholesky_size(max(num_data, settings.max_exact_size) + 1))
+        stack.enter_context(gpytorch.settings.fast_computations(covar_root_decomposition = False, log_prob = False, solves = False))
+    return stack
 
 class NodeGPModel(gpytorch.models.ExactGP):
     
-    def __init__(self, train_x, train_y, likelihood, parents):
+    def __init__(self, train_x, train_y, likelihood, parents, solver = None, kernel_backend = 'dense', tile_size = 1024, policy = None,
+                 group_index = None, data_hash = None):
         super().__init__(train_x, train_y, likelihood)
         self.parents = parents
+        self.policy = get_policy() if policy is None else policy
+        # The tiled backend never materializes the Gram matrix, so it needs iterative solves
+        if solver is None:
+            solver = SolverSettings(mode = 'iterative') if kernel_backend == 'tiled' else SolverSettings()
+        self.solver = solver
+        self.kernel_backend = kernel_backend
+        self.tile_size = tile_size
+        # Group of every training instance when all instances of a group share their inputs, see get_node_groups,
+        # and the first instance of every group. Fits and solves then use the Woodbury identity
+        self.group_index = group_index
+        self.group_rows = None
+        if group_index is not None:
+            counts = torch.bincount(group_index)
+            self.group_rows = torch.argsort(group_index, stable = True)[torch.cumsum(counts, 0) - counts]
+        # Indices of the training instances among all instances of the entity, None if all were used
+        self.train_index = None
+        # Posterior factors, computed lazily by compute_posterior_cache
+        self.posterior_alpha = None
+        self.posterior_chol = None
+        self.posterior_grouped = None
+        # Hash of the training data and parents, and optimizer state of the last fit, used to warm-start refits
+        # A stored hash is passed in by load_scm, since hashing reads all of the memory-mapped training data
+        self.data_hash = node_data_hash(train_x, train_y, parents) if data_hash is None else data_hash
+        self.optimizer_state = None
         self.mean_module = gpytorch.means.ConstantMean()
         self.covar_module = self.compose_kernels()
 
     def compose_kernels(self):
         parents_kernels = []
-        for p in self.parents:
+        # Column i of the input holds the values of the i-th parent
+        for i, p in enumerate(self.parents):
 
             # Self edges are between attributes in the same entity type
             # One to many edges use the same kernel, just with the parent entity's attributes as arguments instead
             if self.parents[p] in ['self', 'one_to_many']:
-                parents_kernels.append(gpytorch.kernels.ScaleKernel(gpytorch.kernels.RBFKernel()))
+                parents_kernels.append(gpytorch.kernels.RBFKernel(active_dims = [i]))
 
             # For many to one relationships, each instance could have a different no. of parents in ground graph
             # Many to many edges use the same kernel, just with the parent entity's attributes as arguments instead
+            # The normalized squared-distance set kernel only depends on the mean of each set, 
+            # so the column holds the mean over the related instances (see get_node_data)
             elif self.parents[p] in ['many_to_one', 'many_to_many']:
-                parents_kernels.append(MultiSetKernel(self.parents))
+                parents_kernels.append(gpytorch.kernels.RBFKernel(active_dims = [i]))
 
-        full_kernel = gpytorch.kernels.ProductStructureKernel(parents_kernels)
+        if self.kernel_backend == 'tiled':
+            return TiledProductKernel(gpytorch.kernels.ProductKernel(*parents_kernels), tile_size = self.tile_size)
+        full_kernel = gpytorch.kernels.ScaleKernel(gpytorch.kernels.ProductKernel(*parents_kernels))
         return full_kernel                
 
+    def solver_context(self):
+        stack = solver_context(self.solver, self.train_targets.shape[-1])
+        stack.enter_context(policy_context(self.policy))
+        return stack
+
+    def grouped_covariance(self) -> GroupedCovariance:
+        """ Training covariance with noise of a grouped node, built from the kernel between the groups
+
+        Returns:
+            GroupedCovariance: Z B Z^T + (noise + jitter) I
+        """
+        group_x = self.train_inputs[0][self.group_rows]
+        group_cov = self.covar_module(group_x).to_dense()
+        return GroupedCovariance(self.group_index, group_cov, self.likelihood.noise.squeeze(-1) + self.policy.jitter)
+
+    def compute_posterior_cache(self):
+        """ Cache (K + noise * I)^{-1} (y - mean), and its Cholesky factor for exact solvers
+        or its Woodbury form for grouped nodes, so that posterior means only need one kernel-vector product
+        """
+        train_x = self.train_inputs[0]
+        with torch.no_grad(), self.solver_context():
+            residual = (self.train_targets - self.mean_module(train_x)).unsqueeze(-1)
+            if self.group_index is not None:
+                instrument.count("gp.posterior_solves")
+                self.posterior_chol = None
+                self.posterior_grouped = self.grouped_covariance()
+                self.posterior_alpha = self.posterior_grouped.solve(residual)
+                return
+            train_cov = self.covar_module(train_x).add_diagonal(self.likelihood.noise)
+            instrument.count("gp.posterior_solves")
+            if uses_iterative_solver(self.solver, train_x.shape[-2]):
+                self.posterior_chol = None
+                self.posterior_alpha = train_cov.solve(residual)
+            else:
+                dense_cov = train_cov.to_dense()
+                dense_cov.diagonal(dim1 = -2, dim2 = -1).add_(self.policy.jitter)
+                self.posterior_chol = torch.linalg.cholesky(dense_cov)
+                self.posterior_alpha = torch.cholesky_solve(residual, self.posterior_chol)
+
+    def clear_posterior_cache(self):
+        self.posterior_alpha = None
+        self.posterior_chol = None
+        self.posterior_grouped = None
+
+    def get_posterior_grouped(self) -> GroupedCovariance:
+        # Checkpoints only store alpha, so the Woodbury form of a loaded model is rebuilt on first use
+        if self.group_index is not None and self.posterior_grouped is None:
+            with torch.no_grad():
+                self.posterior_grouped = self.grouped_covariance()
+        return self.posterior_grouped
+
+    @instrument.instrumented("gp.predict_mean")
+    def predict_mean(self, x: torch.Tensor) -> torch.Tensor:
+        """ Posterior mean of the node function, inputs may have any number of batch dimensions
+
+        Args:
+            x (torch.Tensor): inputs of shape (..., num_instances, num_parents)
+
+        Returns:
+            torch.Tensor: posterior mean of shape (..., num_instances)
+        """
+        if self.posterior_alpha is None:
+            self.compute_posterior_cache()
+        flat_x = x.reshape(-1, x.shape[-1]).to(self.train_inputs[0].dtype)
+        with torch.no_grad(), policy_context(self.policy):
+            cross_cov = self.covar_module(flat_x, self.train_inputs[0])
+            mean = self.mean_module(flat_x) + (cross_cov @ self.posterior_alpha).squeeze(-1)
+        return mean.reshape(x.shape[:-1])
+
+    @instrument.instrumented("gp.predict_variance")
+    def predict_variance(self, x: torch.Tensor) -> torch.Tensor:
+        """ Marginal posterior variance of the node function, from the cached Cholesky factor or Woodbury form
+
+        Args:
+            x (torch.Tensor): inputs of shape (..., num_instances, num_parents)
+
+        Returns:
+            torch.Tensor: posterior variance of shape (..., num_instances)
+        """
+        if self.posterior_alpha is None:
+            self.compute_posterior_cache()
+        flat_x = x.reshape(-1, x.shape[-1]).to(self.train_inputs[0].dtype)
+        with torch.no_grad(), policy_context(self.policy):
+            prior_var = self.covar_module(flat_x, diag = True)
+            grouped = self.get_posterior_grouped()
+            if grouped is not None:
+                cross_cov = self.covar_module(self.train_inputs[0], flat_x).to_dense()
+                variance = (prior_var - (cross_cov * grouped.solve(cross_cov)).sum(dim = -2)).clamp(min = 0)
+                return variance.reshape(x.shape[:-1])
+            if self.posterior_chol is None:
+                # Iterative solvers have no factor to reuse
+                with self.solver_context():
+                    return self(flat_x).variance.reshape(x.shape[:-1])
+            cross_cov = self.covar_module(self.train_inputs[0], flat_x).to_dense()
+            v = torch.linalg.solve_triangular(self.posterior_chol, cross_cov, upper = False)
+            variance = (prior_var - (v ** 2).sum(dim = -2)).clamp(min = 0)
+        return variance.reshape(x.shape[:-1])
+
+    @instrument.instrumented("gp.predict_covariance")
+    def predict_covariance(self, x: torch.Tensor) -> torch.Tensor:
+        """ Joint posterior covariance of the node function at a set of inputs, from the cached Cholesky factor or Woodbury form
+
+        Args:
+            x (torch.Tensor): inputs of shape (num_instances, num_parents)
+
+        Returns:
+            torch.Tensor: posterior covariance of shape (num_instances, num_instances)
+        """
+        if self.posterior_alpha is None:
+            self.compute_posterior_cache()
+        x = x.to(self.train_inputs[0].dtype)
+        with torch.no_grad(), policy_context(self.policy):
+            prior_cov = self.covar_module(x).to_dense()
+            grouped = self.get_posterior_grouped()
+            if grouped is not None:
+                cross_cov = self.covar_module(self.train_inputs[0], x).to_dense()
+                return prior_cov - cross_cov.T @ grouped.solve(cross_cov)
+            if self.posterior_chol is None:
+                # Iterative solvers have no factor to reuse
+                with self.solver_context():
+                    return self(x).covariance_matrix
+            cross_cov = self.covar_module(self.train_inputs[0], x).to_dense()
+            v = torch.linalg.solve_triangular(self.posterior_chol, cross_cov, upper = False)
+            return prior_cov - v.T @ v
+
     def forward(self, x):
+        instrument.count("gp.forward_calls")
         mean_x = self.mean_module(x)
         covar_x = self.covar_module(x)
         return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
 
-class MultiSetKernel(gpytorch.kernels.Kernel):
-
-    def __init__(self, s, lamb, adj_mat_dict):
-        '''
-        Check gpytorch docs for how to implement init and forward
-        '''
-        super().__init__() 
-        self.s = s
-        self.lamb = lamb 
-        self.adj_mat_dict = adj_mat_dict 
-
-    def _distance(self, node1, node2, relation, data):
-        distance = 0
-        adj_mat = self.adj_mat_dict[relation]
-        # Get instances that are related through each node through the given relationship class
-        node1_instances = list(adj_mat.loc[node1.instance, adj_mat.loc[node1.instance] == True].index)
-        node2_instances = list(adj_mat.loc[node2.instance, adj_mat.loc[node2.instance] == True].index)
-        for n1 in node1_instances:
-            for n2 in node2_instances:
-                value1 = data[node1.entity][node1.attribute][node1.instance]
-                value2 = data[node2.entity][node2.attribute][node2.instance]
-                distance += (value1 - value2) ** 2
-        distance /= (len(node1_instances) * len(node2_instances))
-        return distance
-
-    def distance(self, node1, node2, relation, adj_mat_dict, data):
-        return self._distance(node1, node2, relation, adj_mat_dict, data) \
-                - self._distance(node1, node1, relation, adj_mat_dict, data)/2 \
-                - self._distance(node2, node2, relation, adj_mat_dict, data)/2
-
-    def forward(self, node1, node2, relation, adj_mat_dict, data, **params):
-        return self.s * torch.exp(-self.distance(node1, node2, relation, adj_mat_dict, data)/self.lamb)
+@instrument.instrumented("gp.fit_node")
+def fit_node_model(model: NodeGPModel, training_iter: int = 50, lr: float = 0.1, optimizer_state: dict = None) -> list:
+    """ Fit the hyperparameters of a node GP by maximizing the marginal likelihood
 
+    Args:
+        model (NodeGPModel): node GP, its solver settings decide between exact and iterative solves
+        training_iter (int, optional): number of optimizer steps. Defaults to 50.
+        lr (float, optional): learning rate of Adam. Defaults to 0.1.
+        optimizer_state (dict, optional): Adam state of an earlier fit of the same node to resume from. Defaults to None.
 
-    
+    Returns:
+        list: loss after every step
+    """
+    model.clear_posterior_cache()
+    model.train()
+    model.likelihood.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr = lr)
+    if optimizer_state is not None:
+        # Adam updates its loaded state in place, which must not change the state of the earlier fit
+        optimizer.load_state_dict(copy.deepcopy(optimizer_state))
+        # The saved state holds the learning rate of the earlier fit
+        for group in optimizer.param_groups:
+            group['lr'] = lr
+    mll = gpytorch.mlls.ExactMarginalLogLikelihood(model.likelihood, model)
+    losses = []
+    with model.solver_context():
+        for _ in range(training_iter):
+            optimizer.zero_grad()
+            if model.group_index is None:
+                loss = -mll(model(*model.train_inputs), model.train_targets)
+            else:
+                # Same scale as ExactMarginalLogLikelihood, which divides by the number of instances
+                residual = model.train_targets - model.mean_module(model.train_inputs[0])
+                loss = -model.grouped_covariance().log_marginal_likelihood(residual) / residual.shape[0]
+            loss.backward()
+            optimizer.step()
+            instrument.count("gp.optimizer_steps")
+            losses.append(loss.item())
+    model.optimizer_state = optimizer.state_dict()
+    model.eval()
+    model.likelihood.eval()
+    return losses
+
+def node_data_hash(train_x: torch.Tensor, train_y: torch.Tensor, parents: dict) -> str:
+    """ Content hash of the training data of a node, which decides whether a refit can be skipped
+
+    Args:
+        train_x (torch.Tensor): inputs of the node GP
+        train_y (torch.Tensor): targets of the node GP
+        parents (dict): parents dict of the node GP
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(list(parents.items())).encode())
+    for tensor in (train_x, train_y):
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+def get_edge_type(structure: RelationalCausalStructure, relation: str, parent_entity: str, child_entity: str) -> str:
+    """ Type of a relational edge from the cardinalities of its relation
+
+    Args:
+        structure (RelationalCausalStructure): contains schema, edges and relation paths
+        relation (str): relation name or relation path, or "self"
+        parent_entity (str): entity of the parent attribute
+        child_entity (str): entity of the child attribute
+
+    Returns:
+        str: one of 'self', 'one_to_many', 'many_to_one' and 'many_to_many'
+    """
+    if relation == "self":
+        return 'self'
+    cardinality = structure.get_cardinality(relation)
+    if cardinality[parent_entity] == 'one':
+        return 'one_to_many'
+    return 'many_to_one' if cardinality[child_entity] == 'one' else 'many_to_many'
+
+def get_relation_matrix(structure: RelationalCausalStructure, adj_mat_dict: dict, relation: str, parent_entity: str, child_entity: str,
+                        dtype: torch.dtype = None) -> torch.Tensor:
+    """ Adjacency matrix of a relation with one row per child instance and one column per parent instance
+
+    Args:
+        structure (RelationalCausalStructure): contains schema, edges and relation paths
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        relation (str): relation name or relation path
+        parent_entity (str): entity of the parent attribute
+        child_entity (str): entity of the child attribute
+        dtype (torch.dtype, optional): dtype of the matrix. Defaults to the dtype of the global compute policy.
+
+    Returns:
+        torch.Tensor: float matrix of shape (num_child_instances, num_parent_instances)
+    """
+    dtype = get_dtype() if dtype is None else dtype
+    adj_mat = torch.as_tensor(adj_mat_dict[relation].to_numpy(dtype = float, copy = True), dtype = dtype)
+    # Rows of relation path matrices always belong to the parent entity
+    if relation not in structure.relation_paths and structure.schema.relations[relation][0] == child_entity:
+        return adj_mat
+    return adj_mat.T
+
+@instrument.instrumented("gp.kernel_inputs")
+def get_node_data(structure: RelationalCausalStructure, adj_mat_dict: dict, entity: str, attribute: str, values: dict,
+                  dtype: torch.dtype = None) -> Tuple[torch.Tensor, dict]:
+    """ Build the GP inputs of a node from the values of its parents
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        entity (str): entity name of the node
+        attribute (str): attribute name of the node
+        values (dict): key is a RelationalNode and value is a tensor with the attribute of every instance
+        dtype (torch.dtype, optional): dtype of the inputs. Defaults to the dtype of the global compute policy.
+
+    Returns:
+        Tuple[torch.Tensor, dict]: inputs of shape (num_instances, num_parents) 
+                                   and the parents dict for NodeGPModel, keyed by (relation, parent node)
+    """
+    dtype = get_dtype() if dtype is None else dtype
+    parents = {}
+    columns = []
+    for relation, edge in structure.get_incoming_edges(entity, attribute):
+        edge_type = get_edge_type(structure, relation, edge.parent.entity, entity)
+        parent_values = values[edge.parent].to(dtype)
+        if edge_type == 'self':
+            column = parent_values
+        else:
+            relation_matrix = get_relation_matrix(structure, adj_mat_dict, relation, edge.parent.entity, entity, dtype)
+            # Mean over related parent instances, which is the parent value itself for one to many edges
+            counts = relation_matrix.sum(dim = 1).clamp(min = 1)
+            column = (relation_matrix @ parent_values) / counts
+        parents[(relation, edge.parent)] = edge_type
+        columns.append(column)
+    if not columns:
+        return torch.zeros(len(values[RelationalNode(entity, attribute)]), 0, dtype = dtype), parents
+    return torch.stack(columns, dim = -1), parents
+
+def get_skeleton_values(structure: RelationalCausalStructure, skeleton: RelationalSkeleton, dtype: torch.dtype = None) -> dict:
+    """ Values of every attribute in the skeleton
+
+    Args:
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): contains all instances
+        dtype (torch.dtype, optional): dtype of the values. Defaults to the dtype of the global compute policy.
+
+    Returns:
+        dict: key is a RelationalNode and value is a tensor with the attribute of every instance
+    """
+    values = {}
+    for entity, attributes in structure.schema.attribute_classes.items():
+        for attribute in attributes:
+            values[RelationalNode(entity, attribute)] = skeleton.get_attribute_vector(entity, attribute, dtype)
+    return values
+
+@instrument.instrumented("gp.fit_scm")
+def fit_relational_scm(scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict, 
+                        solvers: dict = None, training_iter: int = 50, lr: float = 0.1, kernel_backends: dict = None,
+                        previous_scm: RelationalSCM = None, warm_training_iter: int = None, policies: dict = None) -> RelationalSCM:
+    """ Fit a GP for every node of the SCM that has parents
+
+    Nodes whose instances share their parent values within groups, see get_node_groups, are fitted with
+    Woodbury solves that scale with the number of groups. All other nodes use the dense or iterative solvers.
+    With a previously fitted SCM, e.g. from load_scm, nodes whose parents and training data are unchanged
+    are reused as they are, and all other nodes start from their previous hyperparameters and optimizer state.
+
+    Args:
+        scm (RelationalSCM): SCM whose functions are replaced by fitted NodeGPModels
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+        solvers (dict, optional): SolverSettings per RelationalNode, nodes that are missing use the default settings
+        kernel_backends (dict, optional): 'dense' or 'tiled' per RelationalNode, nodes that are missing are dense
+        training_iter (int, optional): number of optimizer steps per node. Defaults to 50.
+        lr (float, optional): learning rate of Adam. Defaults to 0.1.
+        previous_scm (RelationalSCM, optional): fitted SCM to warm-start from. Defaults to None.
+        warm_training_iter (int, optional): optimizer steps for warm-started nodes. Defaults to training_iter.
+        policies (dict, optional): ComputePolicy per RelationalNode, nodes that are missing use the global policy
+
+    Returns:
+        RelationalSCM: the fitted SCM
+    """
+    solvers = {} if solvers is None else solvers
+    kernel_backends = {} if kernel_backends is None else kernel_backends
+    warm_training_iter = training_iter if warm_training_iter is None else warm_training_iter
+    # Values are read in double precision and cast for each node, so that double precision nodes see the exact data
+    values = get_skeleton_values(scm.structure, skeleton, torch.float64)
+    for node in scm.functions:
+        policy = get_policy(node, policies)
+        dtype = get_dtype(policy)
+        train_x, parents = get_node_data(scm.structure, adj_mat_dict, node.entity, node.attribute, values, dtype)
+        if not parents:
+            continue
+        train_y = values[node].to(dtype)
+        previous = None if previous_scm is None else previous_scm.functions.get(node)
+        if previous is not None and previous.data_hash == node_data_hash(train_x, train_y, parents):
+            instrument.count("gp.skipped_refits")
+            scm.functions[node] = previous
+            continue
+        likelihood = gpytorch.likelihoods.GaussianLikelihood()
+        group_index = get_node_groups(scm.structure, adj_mat_dict, node.entity, node.attribute)
+        if group_index is not None:
+            instrument.count("gp.grouped_nodes")
+        model = NodeGPModel(train_x, train_y, likelihood, parents, solvers.get(node), kernel_backends.get(node, 'dense'), policy = policy,
+                            group_index = group_index).to(dtype)
+        model.train_index = torch.arange(train_x.shape[0])
+        if previous is not None and previous.parents == parents:
+            model.load_state_dict(previous.state_dict())
+            fit_node_model(model, warm_training_iter, lr, previous.optimizer_state)
+        else:
+            fit_node_model(model, training_iter, lr)
+        scm.functions[node] = model
+    return scm
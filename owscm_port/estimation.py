@@ -1,8 +1,57 @@
 import torch
 
 import owscm_port.model as model
+import instrument
 
+@instrument.instrumented("estimation.conditional_ITE")
 def conditional_ITE(uy_lengthscale, ty_lengthscale, xy_lengthscale, y_noise, y_scale, u, x, t, y, do_t):
-    uy_cov_log = torch.sum(model.rbf_kernel_log(u, u, uy_lengthscale))
-    xy_cov_log = torch.sum(model.rbf_kernel_log(x, x, xy_lengthscale))
-    ty_cov_log = torch.sum(model.rbf_kernel_log(t, t, ty_lengthscale))
+    """ Posterior ITE samples for every unit under a batch of interventions on t
+
+    The outcome is modelled as y = f(u, x, t) + noise with a product RBF kernel over u, x and t.
+    For each hyperparameter draw the posterior mean of f is computed at the observed inputs and at
+    each (u_i, x_i, do_t) input, and the ITE of unit i is their difference. Since the noise is
+    additive and shared between the factual and counterfactual worlds, it cancels out.
+    All draws are handled in one batched Cholesky solve.
+
+    Args:
+        uy_lengthscale (torch.Tensor): lengthscale for u, shape (S,) or scalar
+        ty_lengthscale (torch.Tensor): lengthscale for t, shape (S,) or scalar
+        xy_lengthscale (torch.Tensor): lengthscale for x, shape (S,) or scalar
+        y_noise (torch.Tensor): noise variance of y, shape (S,) or scalar
+        y_scale (torch.Tensor): outputscale of the kernel for y, shape (S,) or scalar
+        u (torch.Tensor): confounder values, shape (n,)
+        x (torch.Tensor): covariate values, shape (n,)
+        t (torch.Tensor): observed treatment values, shape (n,)
+        y (torch.Tensor): observed outcomes, shape (n,)
+        do_t (torch.Tensor): intervened treatment values, shape (D,) or scalar
+
+    Returns:
+        torch.Tensor: ITE samples of shape (S, D, n)
+    """
+    dtype = y.dtype
+    hyperparams = [torch.as_tensor(h, dtype=dtype).reshape(-1) for h in 
+                    (uy_lengthscale, ty_lengthscale, xy_lengthscale, y_noise, y_scale)]
+    uy_lengthscale, ty_lengthscale, xy_lengthscale, y_noise, y_scale = torch.broadcast_tensors(*hyperparams)
+    do_t = torch.as_tensor(do_t, dtype=dtype).reshape(-1)
+
+    # Log-covariance shared by the factual and counterfactual inputs, shape (S, n, n)
+    base_cov = model.LogKernelComposer(y.shape[0], batch_shape = y_scale.shape, dtype = dtype)
+    base_cov.add_rbf(u, u, uy_lengthscale).add_rbf(x, x, xy_lengthscale)
+
+    # One batched Cholesky solve for all draws
+    cov = base_cov.copy().add_rbf(t, t, ty_lengthscale).covariance(y_scale, y_noise)
+    cov_chol = torch.linalg.cholesky(cov)
+    instrument.count("estimation.cholesky_solves", cov.shape[0])
+    y_batch = y.reshape(1, -1, 1).expand(cov.shape[0], -1, -1)
+    alpha = torch.cholesky_solve(y_batch, cov_chol)
+
+    # Posterior mean at the observed inputs, shape (S, n), using (K + noise * I) alpha = y
+    factual_mean = y.unsqueeze(0) - (y_noise.unsqueeze(-1) * alpha.squeeze(-1))
+
+    # The t-term of the counterfactual cross-covariance only depends on the training unit,
+    # so it is folded into the weights instead of building one n x n matrix per do_t value
+    do_t_cov = torch.exp(model.rbf_kernel_log(do_t, t, ty_lengthscale))
+    weights = do_t_cov * alpha.transpose(-1, -2)
+    counterfactual_mean = base_cov.covariance(y_scale) @ weights.transpose(-1, -2)
+
+    return counterfactual_mean.transpose(-1, -2) - factual_mean.unsqueeze(-2)
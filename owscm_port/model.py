@@ -3,14 +3,73 @@ import pyro
 import pyro.distributions as dist
 
 def rbf_kernel_log(x_1, x_2, lengthscale):
-    # CAREFUL! Reimplement difference!
-    return torch.outer(x_1, x_2) / (lengthscale**2)
+    # A batch of lengthscales of shape (S,) gives a batch of log-covariances of shape (S, n, m)
+    lengthscale = torch.as_tensor(lengthscale, dtype=x_1.dtype)
+    sq_diff = (x_1.reshape(-1, 1) - x_2.reshape(1, -1)) ** 2
+    return -sq_diff / lengthscale.reshape(lengthscale.shape + (1, 1)) ** 2
 
 def expit(x):
     return torch.exp(x) / (1.0 + torch.exp(x))
 
 def process_cov(log_cov, scale, noise = 0):
-    return torch.exp(log_cov) * scale + noise * torch.eye(log_cov.shape[0])
+    # Scale and noise may be batched along the leading dimensions of log_cov
+    scale = torch.as_tensor(scale, dtype=log_cov.dtype)
+    noise = torch.as_tensor(noise, dtype=log_cov.dtype)
+    eye = torch.eye(log_cov.shape[-2], log_cov.shape[-1], dtype=log_cov.dtype)
+    return torch.exp(log_cov) * scale[..., None, None] + noise[..., None, None] * eye
+
+class LogKernelComposer:
+    """ Accumulates a product of kernels as a sum of log-covariances in one preallocated buffer
+
+    Every component is added in place, so composing a kernel from many parents needs a single
+    n x m buffer instead of one temporary per component. covariance() exponentiates the buffer
+    in place, after which the composer has to be reset before it is reused.
+    """
+
+    def __init__(self, n, m = None, batch_shape = (), dtype = torch.float32, out = None):
+        m = n if m is None else m
+        self.batch_shape = torch.Size(batch_shape)
+        if out is None:
+            self.buffer = torch.zeros(self.batch_shape + (n, m), dtype = dtype)
+        else:
+            self.buffer = out.zero_()
+
+    def reset(self):
+        self.buffer.zero_()
+        return self
+
+    def copy(self):
+        composer = LogKernelComposer.__new__(LogKernelComposer)
+        composer.batch_shape = self.batch_shape
+        composer.buffer = self.buffer.clone()
+        return composer
+
+    def _batched(self, value):
+        # Hyperparameters of shape batch_shape broadcast over the last two dimensions of the buffer
+        value = torch.as_tensor(value, dtype = self.buffer.dtype)
+        return value.reshape(value.shape + (1, 1))
+
+    def add_rbf(self, x_1, x_2, lengthscale, tile_size = 1024):
+        # -(x_1 - x_2)^2 / l^2 is added a block of rows at a time, so the only temporary is a tile_size x m
+        # block of exact squared differences. Expanding the square instead cancels catastrophically
+        # in float32 for inputs that are far from zero
+        neg_inv_sq_lengthscale = -self._batched(lengthscale) ** -2
+        x_1 = x_1.reshape(-1, 1).to(self.buffer.dtype)
+        x_2 = x_2.reshape(1, -1).to(self.buffer.dtype)
+        for start in range(0, x_1.shape[0], tile_size):
+            sq_diff = (x_1[start:start + tile_size] - x_2) ** 2
+            self.buffer[..., start:start + tile_size, :].addcmul_(sq_diff, neg_inv_sq_lengthscale)
+        return self
+
+    def add_log_kernel(self, log_cov):
+        self.buffer.add_(log_cov)
+        return self
+
+    def covariance(self, scale, noise = 0):
+        cov = self.buffer.exp_()
+        cov.mul_(self._batched(scale))
+        cov.diagonal(dim1 = -2, dim2 = -1).add_(torch.as_tensor(noise, dtype = cov.dtype).unsqueeze(-1))
+        return cov
 
 def generate_lengthscale(shape, scale):
     lengthscale = pyro.sample("lengthscale", dist.InverseGamma(shape, scale))
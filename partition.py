@@ -0,0 +1,218 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import gpytorch
+
+# Import classes and functions for relational models
+from relational import *
+from model import get_node_data, get_skeleton_values
+from estimation import batch_effect_estimation
+import instrument
+
+def get_instance_index(skeleton: RelationalSkeleton) -> dict:
+    """ Global index of every entity instance
+
+    Args:
+        skeleton (RelationalSkeleton): contains all instances
+
+    Returns:
+        dict: key is the entity name and value is an array with the global index of each of its instances
+    """
+    instance_index = {}
+    offset = 0
+    for entity, instances in skeleton.entity_instances.items():
+        num_instances = len(instances["names"])
+        instance_index[entity] = np.arange(offset, offset + num_instances)
+        offset += num_instances
+    return instance_index
+
+@instrument.instrumented("partition.components")
+def find_components(schema: RelationalSchema, skeleton: RelationalSkeleton, adj_mat_dict: dict) -> np.ndarray:
+    """ Find the weakly connected components of the skeleton from its adjacency matrices
+
+    Two instances are in the same component if they are connected through any chain of relationship instances,
+    which makes the ground graph of every component independent of all others.
+
+    Args:
+        schema (RelationalSchema): relational schema
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+
+    Returns:
+        np.ndarray: component label of every instance, in the order of get_instance_index
+    """
+    instance_index = get_instance_index(skeleton)
+    num_instances = sum(len(index) for index in instance_index.values())
+    sources = []
+    targets = []
+    for relation, (entity_1, entity_2) in schema.relations.items():
+        rows, cols = np.nonzero(adj_mat_dict[relation].to_numpy(dtype = bool))
+        sources.append(instance_index[entity_1][rows])
+        targets.append(instance_index[entity_2][cols])
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype = int)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype = int)
+
+    # Propagate the smallest label along edges and compress label chains until nothing changes
+    labels = np.arange(num_instances)
+    while True:
+        edge_labels = np.minimum(labels[sources], labels[targets])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, sources, edge_labels)
+        np.minimum.at(new_labels, targets, edge_labels)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    # Relabel components as 0, 1, 2, ...
+    return np.unique(labels, return_inverse = True)[1]
+
+def split_skeleton(schema: RelationalSchema, skeleton: RelationalSkeleton, labels: np.ndarray, return_members: bool = False) -> list:
+    """ Split the skeleton into one skeleton per component
+
+    Args:
+        schema (RelationalSchema): relational schema
+        skeleton (RelationalSkeleton): contains all instances
+        labels (np.ndarray): component label of every instance from find_components
+        return_members (bool, optional): also return the positions of the instances of every component. Defaults to False.
+
+    Returns:
+        list: one RelationalSkeleton per component, largest component first. With return_members,
+              (skeleton, members) tuples where members maps every entity to the positions of its instances in the full skeleton
+    """
+    instance_index = get_instance_index(skeleton)
+    component_of = {}
+    num_components = int(labels.max()) + 1 if len(labels) else 0
+    components = [RelationalSkeleton(schema) for _ in range(num_components)]
+    members_of = [{} for _ in range(num_components)]
+    for entity, instances in skeleton.entity_instances.items():
+        entity_labels = labels[instance_index[entity]]
+        for component_id, component in enumerate(components):
+            members = np.nonzero(entity_labels == component_id)[0]
+            members_of[component_id][entity] = members
+            component.entity_instances[entity] = {key: [values[i] for i in members] for key, values in instances.items()}
+            for name in component.entity_instances[entity]["names"]:
+                component.instance_type[name] = entity
+        component_of.update(zip(instances["names"], entity_labels.tolist()))
+    for relation, edge_list in skeleton.relationship_instances.items():
+        for instance_edge in edge_list:
+            components[component_of[instance_edge[0]]].relationship_instances[relation].append(instance_edge)
+    order = sorted(range(num_components), key = lambda i: -len(components[i].instance_type))
+    if return_members:
+        return [(components[i], members_of[i]) for i in order]
+    return [components[i] for i in order]
+
+# Fitted SCM shared by all components in the current process
+_worker_state = {}
+
+def _init_worker(num_threads, scm):
+    # Avoid oversubscribing the cores when every worker runs its own torch thread pool
+    torch.set_num_threads(num_threads)
+    _worker_state["scm"] = scm
+
+def _run_component(fn, schema, structure, component, kwargs):
+    if "scm" in _worker_state and _worker_state["scm"] is not None:
+        kwargs = dict(kwargs, scm = _worker_state["scm"])
+    return fn(schema, structure, component, **kwargs)
+
+def map_components(fn, schema: RelationalSchema, structure: RelationalCausalStructure, skeleton: RelationalSkeleton,
+                   adj_mat_dict: dict = None, max_workers: int = None, threads_per_worker: int = 1, scm: RelationalSCM = None, **kwargs) -> dict:
+    """ Run a function on every connected component of the skeleton in a process pool and merge the results
+
+    Args:
+        fn (callable): module-level function called as fn(schema, structure, component_skeleton, **kwargs), returning a dict
+        schema (RelationalSchema): relational schema
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): contains all instances
+        adj_mat_dict (dict, optional): adjacency matrices, built from the skeleton if missing. Defaults to None.
+        max_workers (int, optional): number of worker processes, or 0 to run in this process. Defaults to the number of CPUs.
+        threads_per_worker (int, optional): torch threads in each worker. Defaults to 1.
+        scm (RelationalSCM, optional): SCM fitted on the whole skeleton, sent once to every worker and passed to fn as scm. 
+                                       Its posterior factors are computed before, so that workers do not repeat the solves.
+
+    Returns:
+        dict: union of the dicts returned for all components
+    """
+    if adj_mat_dict is None:
+        adj_mat_dict = create_adj_mat_dict(structure, skeleton)
+    components = split_skeleton(schema, skeleton, find_components(schema, skeleton, adj_mat_dict))
+    if scm is not None:
+        for model in scm.functions.values():
+            if model is not None and model.posterior_alpha is None:
+                model.compute_posterior_cache()
+    results = {}
+    if max_workers == 0:
+        if scm is not None:
+            kwargs = dict(kwargs, scm = scm)
+        for component in components:
+            results.update(fn(schema, structure, component, **kwargs))
+        return results
+    with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_worker, initargs = (threads_per_worker, scm)) as pool:
+        futures = [pool.submit(_run_component, fn, schema, structure, component, kwargs) for component in components]
+        for future in futures:
+            results.update(future.result())
+    return results
+
+def component_posterior_samples(schema: RelationalSchema, structure: RelationalCausalStructure, skeleton: RelationalSkeleton,
+                                scm: RelationalSCM, node: RelationalNode, num_samples: int = 100) -> dict:
+    """ Sample the posterior of a node at every instance of one component
+
+    All instances share the node functions, so the SCM is fitted once on the whole skeleton and only the
+    sampling is split. Samples are joint within a component and independent between components.
+
+    Args:
+        schema (RelationalSchema): relational schema
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): skeleton of a single component
+        scm (RelationalSCM): SCM fitted on the whole skeleton
+        node (RelationalNode): node to sample
+        num_samples (int, optional): number of posterior samples. Defaults to 100.
+
+    Returns:
+        dict: key is an InstanceNode and value is a tensor of posterior samples
+    """
+    model = scm.functions[node]
+    names = skeleton.entity_instances[node.entity]["names"]
+    if model is None:
+        # Root nodes are not modelled, their observed values are returned as is
+        values = skeleton.get_attribute_vector(node.entity, node.attribute)
+        samples = values.unsqueeze(0).expand(num_samples, -1)
+    else:
+        adj_mat_dict = create_adj_mat_dict(structure, skeleton)
+        values = get_skeleton_values(structure, skeleton)
+        test_x, _ = get_node_data(structure, adj_mat_dict, node.entity, node.attribute, values, model.train_inputs[0].dtype)
+        mean = model.predict_mean(test_x)
+        covariance = model.predict_covariance(test_x)
+        covariance.diagonal().add_(model.likelihood.noise.detach().squeeze(-1) + model.policy.jitter)
+        samples = gpytorch.distributions.MultivariateNormal(mean, covariance).sample(torch.Size((num_samples,)))
+    return {InstanceNode(node.entity, node.attribute, name): samples[:, i] for i, name in enumerate(names)}
+
+def component_effects(schema: RelationalSchema, structure: RelationalCausalStructure, skeleton: RelationalSkeleton,
+                      scm: RelationalSCM, treatment: RelationalNode, outcome: RelationalNode,
+                      treatment_value: float = 1., control_value: float = 0., batch_size: int = None) -> dict:
+    """ Effects of every treatment instance on every outcome instance of one component
+
+    Interventions on one component do not reach any other component, so batch_effect_estimation only needs
+    the instances of the component, with the SCM fitted on the whole skeleton.
+
+    Args:
+        schema (RelationalSchema): relational schema
+        structure (RelationalCausalStructure): contains schema and edges
+        skeleton (RelationalSkeleton): skeleton of a single component
+        scm (RelationalSCM): SCM fitted on the whole skeleton
+        treatment (RelationalNode): treated attribute
+        outcome (RelationalNode): outcome attribute
+        treatment_value (float, optional): value under treatment. Defaults to 1.
+        control_value (float, optional): value under control. Defaults to 0.
+        batch_size (int, optional): treatment instances per sweep, to bound memory. Defaults to all of them.
+
+    Returns:
+        dict: key is a (treatment InstanceNode, outcome InstanceNode) tuple and value is the effect
+    """
+    treatments = [InstanceNode(treatment.entity, treatment.attribute, name) for name in skeleton.entity_instances[treatment.entity]["names"]]
+    outcomes = [InstanceNode(outcome.entity, outcome.attribute, name) for name in skeleton.entity_instances[outcome.entity]["names"]]
+    if not treatments or not outcomes:
+        return {}
+    adj_mat_dict = create_adj_mat_dict(structure, skeleton)
+    effects = batch_effect_estimation(scm, skeleton, adj_mat_dict, treatments, outcomes, treatment_value, control_value,
+                                      batch_size = batch_size)
+    return {(t, o): effects[i, j].item() for i, t in enumerate(treatments) for j, o in enumerate(outcomes)}
@@ -0,0 +1,81 @@
+from __future__ import annotations
+from collections import namedtuple
+from contextlib import ExitStack
+
+from lazy import lazy_import
+
+torch = lazy_import('torch')
+gpytorch = lazy_import('gpytorch')
+
+# Precision and threading used for GP computations
+# dtype is the name of a torch floating point type, jitter is added to the diagonal before Cholesky factorizations,
+# thread counts of None keep the torch defaults and deterministic turns on torch.use_deterministic_algorithms
+# Threads and determinism are process-wide and come from the global policy, per-node policies only set dtype and jitter
+ComputePolicy = namedtuple('ComputePolicy', 'dtype jitter intra_op_threads inter_op_threads deterministic',
+                           defaults = ('float32', 1e-6, None, None, False))
+
+_global_policy = ComputePolicy()
+
+def set_global_policy(policy: ComputePolicy):
+    """ Set the default policy of all nodes and apply its thread counts and deterministic mode to the process
+    """
+    global _global_policy
+    _global_policy = policy
+    apply_process_settings(policy)
+
+def get_global_policy() -> ComputePolicy:
+    return _global_policy
+
+def get_policy(node = None, policies: dict = None) -> ComputePolicy:
+    """ Policy of a node, falling back to the global policy
+
+    Args:
+        node (RelationalNode, optional): node whose policy is looked up. Defaults to None.
+        policies (dict, optional): ComputePolicy per RelationalNode. Defaults to None.
+
+    Returns:
+        ComputePolicy: the policy of the node
+    """
+    if policies is not None and node in policies:
+        return policies[node]
+    return _global_policy
+
+def get_dtype(policy: ComputePolicy = None) -> torch.dtype:
+    policy = _global_policy if policy is None else policy
+    return getattr(torch, policy.dtype)
+
+def apply_process_settings(policy: ComputePolicy = None):
+    """ Apply the thread counts and deterministic mode of a policy to the whole process
+
+    These are process-wide torch settings, so they are applied once per process or worker instead of
+    around every call, where threads running nodes with different policies would overwrite each other.
+    The inter-op thread pool can only be sized before torch starts any parallel work,
+    so later changes to inter_op_threads are reported and ignored.
+
+    Args:
+        policy (ComputePolicy, optional): policy to apply. Defaults to the global policy.
+    """
+    policy = _global_policy if policy is None else policy
+    if policy.intra_op_threads is not None and policy.intra_op_threads != torch.get_num_threads():
+        torch.set_num_threads(policy.intra_op_threads)
+    if policy.inter_op_threads is not None and policy.inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(policy.inter_op_threads)
+        except RuntimeError:
+            print(f"Inter-op threads are already fixed at {torch.get_num_interop_threads()}, could not set {policy.inter_op_threads}")
+    if policy.deterministic != torch.are_deterministic_algorithms_enabled():
+        torch.use_deterministic_algorithms(policy.deterministic)
+
+def policy_context(policy: ComputePolicy = None) -> ExitStack:
+    """ Enter the Cholesky jitter of a policy, which is restored on exit
+
+    Args:
+        policy (ComputePolicy, optional): policy to apply. Defaults to the global policy.
+
+    Returns:
+        ExitStack: context manager holding the gpytorch settings
+    """
+    policy = _global_policy if policy is None else policy
+    stack = ExitStack()
+    stack.enter_context(gpytorch.settings.cholesky_jitter(float_value = policy.jitter, double_value = policy.jitter))
+    return stack
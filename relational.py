@@ -1,9 +1,22 @@
+from __future__ import annotations
 import json
 from collections import namedtuple 
-import torch
-import numpy as np
-import pandas as pd
-import networkx as nx
+from itertools import repeat
+from operator import itemgetter
+import instrument
+from lazy import lazy_import
+from policy import get_dtype
+
+# Heavy dependencies are only imported when they are first used,
+# so schema and skeleton handling stays fast to import
+torch = lazy_import('torch')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+nx = lazy_import('networkx')
+
+__all__ = ['CausalEdge', 'RelationalNode', 'InstanceNode', 'RelationalSchema', 'RelationalSkeleton', 'RelationalCausalStructure',
+           'RelationalSCM', 'create_adj_mat_dict', 'create_relation_matrix', 'create_path_matrix', 'get_path_matrix', 'get_node_name',
+           'create_ground_graph', 'create_subgraph_for_ITE']
 
 CausalEdge = namedtuple('CausalEdge', 'parent child')
 RelationalNode = namedtuple('RelationalNode', 'entity attribute')
@@ -24,6 +37,7 @@ class RelationalSchema:
         self.cardinality = {} # each key is [relationship class][entity class] and value is 'one' or 'many'
         self.relations = {} # each key is a relationship class and value is an (entity class, entity class) tuple
     
+    @instrument.instrumented("relational.load_schema")
     def load_from_file(self, path_to_json):
         with open(path_to_json, 'r') as f:
             schema_dict = json.load(f)
@@ -52,18 +66,40 @@ class RelationalSchema:
         else:
             print("Schema is invalid, could not write to file")
 
-    def is_valid_schema(self):
+    def validate(self) -> list:
+        """ Check the schema and collect every violation
+
+        Returns:
+            list: one message per violation, empty if the schema is valid
+        """
+        violations = []
         for entity in self.entity_classes:
             if entity not in self.attribute_classes or not isinstance(self.attribute_classes[entity], list):
-                return False
+                violations.append(f"Attributes of entity {entity} are not in a list or missing")
         for relation in self.relationship_classes:
             if relation not in self.cardinality:
-               return False
+                violations.append(f"Cardinality of relation {relation} is missing")
             else:
                 for entity in self.cardinality[relation]:
-                    if entity not in self.entity_classes or self.cardinality[relation][entity] not in ['one', 'many']:
-                        return False
-        return True
+                    if entity not in self.entity_classes:
+                        violations.append(f"Cardinality of relation {relation} refers to unknown entity {entity}")
+                    if self.cardinality[relation][entity] not in ['one', 'many']:
+                        violations.append(f"Cardinality of {entity} in relation {relation} is not 'one' or 'many'")
+            if relation not in self.relations:
+                violations.append(f"Entities of relation {relation} are missing")
+            else:
+                for entity in self.relations[relation]:
+                    if entity not in self.entity_classes:
+                        violations.append(f"Relation {relation} refers to unknown entity {entity}")
+                    elif relation in self.cardinality and entity not in self.cardinality[relation]:
+                        violations.append(f"Cardinality of {entity} in relation {relation} is missing")
+        return violations
+
+    def is_valid_schema(self):
+        violations = self.validate()
+        for violation in violations:
+            print(violation)
+        return len(violations) == 0
 
 
 class RelationalSkeleton:
@@ -83,10 +119,12 @@ class RelationalSkeleton:
         for relation in schema.relationship_classes:
             self.relationship_instances[relation] = []
         self.instance_type = {}
+        self.path_matrices = {} # sparse adjacency matrices of relation paths, filled by get_path_matrix
 
     def get_instance_type(self, instance):
         return self.instance_type[instance]
 
+    @instrument.instrumented("relational.load_skeleton")
     def load_from_file(self, schema, path_to_json):
         with open(path_to_json, 'r') as f:
             skeleton_dict = json.load(f)
@@ -96,6 +134,7 @@ class RelationalSkeleton:
             for name in self.entity_instances[entity]["names"]:
                 self.instance_type[name] = entity
         self.relationship_instances = skeleton_dict["relationship_instances"]
+        self.path_matrices = {}
         for relation in self.relationship_instances:
             self.relationship_instances[relation] = [tuple(e) for e in self.relationship_instances[relation]]
         if not self.is_valid_skeleton(schema):
@@ -113,46 +152,96 @@ class RelationalSkeleton:
         else:
             print("Skeleton is invalid for the given schema, could not write to file")                
 
-    def is_valid_skeleton(self, schema):
+    @instrument.instrumented("relational.validate_skeleton")
+    def validate(self, schema) -> list:
+        """ Check the skeleton against the schema and collect every violation
+
+        Relationship endpoints are resolved to integer instance indices in one pass per relation,
+        after which entity types and cardinalities are checked with array operations.
+
+        Args:
+            schema (RelationalSchema): relational schema
+
+        Returns:
+            list: one message per violation, empty if the skeleton is valid
+        """
+        violations = []
+        valid_entities = []
         for entity in schema.entity_classes:
             if entity not in self.entity_instances or not isinstance(self.entity_instances[entity], dict):
-                print(f"Entity {entity} in the schema is missing in the skeleton")
-                return False
+                violations.append(f"Entity {entity} in the schema is missing in the skeleton")
+                continue
             if "names" not in self.entity_instances[entity]:
-                print(f"Names are missing for entity {entity}")
-                return False
+                violations.append(f"Names are missing for entity {entity}")
+                continue
+            valid_entities.append(entity)
             for attribute in schema.attribute_classes[entity]:
                 if attribute not in self.entity_instances[entity]:
-                    print(f"Attribute {entity}.{attribute} in the schema is missing in the skeleton")
-                    return False
-                if not isinstance(self.entity_instances[entity][attribute], list):
-                    print(f"Values of {entity}.{attribute} are not in a list or missing")
-                    return False
-                if len(self.entity_instances[entity][attribute]) != len(self.entity_instances[entity]["names"]):
-                    print(f"Number of values of {entity}.{attribute} are not equal to the number of instance names")
-                    return False
-        all_instance_names = self.instance_type.keys()
+                    violations.append(f"Attribute {entity}.{attribute} in the schema is missing in the skeleton")
+                elif not isinstance(self.entity_instances[entity][attribute], list):
+                    violations.append(f"Values of {entity}.{attribute} are not in a list or missing")
+                elif len(self.entity_instances[entity][attribute]) != len(self.entity_instances[entity]["names"]):
+                    violations.append(f"Number of values of {entity}.{attribute} are not equal to the number of instance names")
+
+        # Global index and entity code of every instance
+        entity_code = {entity: code for code, entity in enumerate(valid_entities)}
+        names = [name for entity in valid_entities for name in self.entity_instances[entity]["names"]]
+        codes = np.concatenate([np.full(len(self.entity_instances[entity]["names"]), entity_code[entity]) for entity in valid_entities] 
+                               + [np.zeros(0, dtype = int)])
+        name_index = dict(zip(names, range(len(names))))
+        if len(name_index) < len(names):
+            violations.append(f"{len(names) - len(name_index)} instance names are used more than once")
+
         for relation in schema.relationship_classes:
             if relation not in self.relationship_instances or not isinstance(self.relationship_instances[relation], list):
-               return False
-            else:
-                for item in self.relationship_instances[relation]:
-                    if not isinstance(item, tuple) or item[0] not in all_instance_names or item[1] not in all_instance_names:
-                        return False
-        return True
+                violations.append(f"Instances of relation {relation} are not in a list or missing")
+                continue
+            edges = self.relationship_instances[relation]
+            if not set(map(type, edges)) <= {tuple} or not set(map(len, edges)) <= {2}:
+                violations.append(f"Instances of relation {relation} are not all (instance, instance) tuples")
+                continue
+            endpoints = [np.fromiter(map(name_index.get, map(itemgetter(i), edges), repeat(-1)), dtype = np.int64, count = len(edges)) 
+                         for i in range(2)]
+            missing = (endpoints[0] < 0) | (endpoints[1] < 0)
+            if missing.any():
+                violations.append(f"{int(missing.sum())} instances of relation {relation} refer to unknown instances")
+            if relation not in schema.relations:
+                continue
+            for i, entity in enumerate(schema.relations[relation]):
+                known = endpoints[i][~missing]
+                if entity not in entity_code:
+                    continue
+                wrong_type = codes[known] != entity_code[entity]
+                if wrong_type.any():
+                    violations.append(f"{int(wrong_type.sum())} instances of relation {relation} have an endpoint {i} that is not a {entity}")
+                # If an entity is on the 'one' side, every instance of the other entity is related to at most one of its instances
+                other = endpoints[1 - i][~missing]
+                if schema.cardinality.get(relation, {}).get(entity) == 'one' and len(other) > 0:
+                    degrees = np.bincount(other)
+                    if degrees.max() > 1:
+                        other_entity = schema.relations[relation][1 - i]
+                        violations.append(f"{int((degrees > 1).sum())} instances of {other_entity} are related to more than one {entity} through {relation}")
+        return violations
+
+    def is_valid_skeleton(self, schema):
+        violations = self.validate(schema)
+        for violation in violations:
+            print(violation)
+        return len(violations) == 0
 
-    def get_attribute_vector(self, entity: str, attribute: str) -> torch.Tensor:
+    def get_attribute_vector(self, entity: str, attribute: str, dtype: torch.dtype = None) -> torch.Tensor:
         """ Obtain list of instances of given attribute in given entity
 
         Args:
             entity (str): entity name
             attribute (str): attribute name
+            dtype (torch.dtype, optional): dtype of the tensor. Defaults to the dtype of the global compute policy.
 
         Returns:
             torch.Tensor: list of all instances of given attribute in the given entity
         """
         attribute_instances = self.entity_instances[entity][attribute]
-        return torch.Tensor(attribute_instances)
+        return torch.tensor(attribute_instances, dtype = get_dtype() if dtype is None else dtype)
 
 class RelationalCausalStructure:
     """
@@ -164,7 +253,9 @@ class RelationalCausalStructure:
         self.nodes = set()
         self.parents = {}
         self.incoming_edges = self.create_incoming_edges_dict()
+        self.relation_paths = self.create_relation_paths_dict()
 
+    @instrument.instrumented("relational.load_structure")
     def load_edges_from_file(self, path_to_json):
         with open(path_to_json, 'r') as f:
             self.edges = json.load(f)
@@ -184,6 +275,8 @@ class RelationalCausalStructure:
                     self.parents[edge.child].append(edge.parent)
                 if edge.parent not in self.parents:
                     self.parents[edge.parent] = []
+        self.incoming_edges = self.create_incoming_edges_dict()
+        self.relation_paths = self.create_relation_paths_dict()
 
     def save_edges_to_file(self, path_to_json):
         with open(path_to_json, 'w') as f:
@@ -206,6 +299,52 @@ class RelationalCausalStructure:
     def get_incoming_edges(self, entity_name, attribute_name):
         return self.incoming_edges[entity_name][attribute_name]   
 
+    def create_relation_paths_dict(self):
+        # Edges keyed by relation names joined with dots, e.g. "contains.resides", go through several relations
+        # Key is the relation path and value is a dict with the hops as (relation, from entity, to entity) tuples,
+        # the entities at both ends of the path and the cardinality of each end
+        relation_paths = {}
+        for relation, edge_list in self.edges.items():
+            hops = relation.split('.')
+            if len(hops) < 2 or not edge_list:
+                continue
+            start = edge_list[0].parent.entity
+            if any(edge.parent.entity != start for edge in edge_list):
+                print(f"Edges through relation path {relation} start from different entities")
+                continue
+            path = {"hops": [], "cardinality": {}}
+            current = start
+            for hop in hops:
+                if hop not in self.schema.relations or current not in self.schema.relations[hop]:
+                    print(f"Relation path {relation} is not connected at {hop}")
+                    break
+                entity_0, entity_1 = self.schema.relations[hop]
+                following = entity_1 if current == entity_0 else entity_0
+                path["hops"].append((hop, current, following))
+                current = following
+            else:
+                if any(edge.child.entity != current for edge in edge_list):
+                    print(f"Edges through relation path {relation} do not end at entity {current}")
+                    continue
+                path["entities"] = (start, current)
+                # Each end instance is related to at most one start instance if every hop is 'one' on its from side
+                from_one = all(self.schema.cardinality[hop][a] == 'one' for hop, a, _ in path["hops"])
+                to_one = all(self.schema.cardinality[hop][b] == 'one' for hop, _, b in path["hops"])
+                path["cardinality"] = {start: 'one' if from_one else 'many', current: 'one' if to_one else 'many'}
+                relation_paths[relation] = path
+        return relation_paths
+
+    def get_relation_entities(self, relation):
+        """ Entities related by a relation or relation path, for paths the parent entity comes first """
+        if relation in self.relation_paths:
+            return self.relation_paths[relation]["entities"]
+        return self.schema.relations[relation]
+
+    def get_cardinality(self, relation):
+        if relation in self.relation_paths:
+            return self.relation_paths[relation]["cardinality"]
+        return self.schema.cardinality[relation]
+
 class RelationalSCM:
     """
     Relational SCM
@@ -216,7 +355,17 @@ class RelationalSCM:
         for node in self.structure.nodes:
             self.functions[node] = None
 
+    @property
+    def topological_ordering(self) -> list:
+        """ Nodes of the SCM ordered so that every node comes after all of its parents """
+        graph = nx.DiGraph()
+        graph.add_nodes_from(sorted(self.structure.nodes))
+        for child, parents in self.structure.parents.items():
+            graph.add_edges_from((parent, child) for parent in parents)
+        return list(nx.lexicographical_topological_sort(graph))
+
 
+@instrument.instrumented("relational.adjacency")
 def create_adj_mat_dict(structure: RelationalCausalStructure, skeleton: RelationalSkeleton) -> dict:
     """ Creates adjacency matrices based on the relational skeleton
 
@@ -238,8 +387,73 @@ def create_adj_mat_dict(structure: RelationalCausalStructure, skeleton: Relation
         for instance_edge in skeleton.relationship_instances[relation_name]:
             adj_mat.loc[instance_edge[0], instance_edge[1]] = True
         adj_mat_dict[relation_name] = adj_mat
+
+    # Composed adjacency matrices for relation paths, with one row per instance of the parent entity
+    for relation_path, path in structure.relation_paths.items():
+        start, end = path["entities"]
+        path_mat = get_path_matrix(structure, skeleton, relation_path)
+        adj_mat = np.zeros(path_mat.shape, dtype = bool)
+        adj_mat[tuple(path_mat.indices().numpy())] = True
+        adj_mat_dict[relation_path] = pd.DataFrame(adj_mat, index = skeleton.entity_instances[start]["names"], 
+                                                   columns = skeleton.entity_instances[end]["names"])
     return adj_mat_dict
 
+def create_relation_matrix(skeleton: RelationalSkeleton, relation: str, from_entity: str, to_entity: str) -> torch.Tensor:
+    """ Sparse adjacency matrix of a relation with one row per instance of from_entity
+
+    Args:
+        skeleton (RelationalSkeleton): contains all instances
+        relation (str): relation name
+        from_entity (str): entity of the rows
+        to_entity (str): entity of the columns
+
+    Returns:
+        torch.Tensor: sparse COO matrix with ones for related instances
+    """
+    row_index = {name: i for i, name in enumerate(skeleton.entity_instances[from_entity]["names"])}
+    col_index = {name: i for i, name in enumerate(skeleton.entity_instances[to_entity]["names"])}
+    pairs = [(row_index[a], col_index[b]) for a, b in skeleton.relationship_instances[relation] if a in row_index and b in col_index]
+    if from_entity != to_entity:
+        # Relationship instances may be stored in either direction
+        pairs += [(row_index[b], col_index[a]) for a, b in skeleton.relationship_instances[relation] if b in row_index and a in col_index]
+    indices = torch.tensor(pairs, dtype = torch.long).reshape(-1, 2).T
+    size = (len(row_index), len(col_index))
+    return torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), size, check_invariants = False).coalesce()
+
+def get_path_matrix(structure: RelationalCausalStructure, skeleton: RelationalSkeleton, relation_path: str) -> torch.Tensor:
+    """ Sparse adjacency matrix of a relation path, computed once per skeleton and cached on it
+
+    Args:
+        structure (RelationalCausalStructure): contains schema, edges and relation paths
+        skeleton (RelationalSkeleton): contains all instances
+        relation_path (str): relation names joined with dots
+
+    Returns:
+        torch.Tensor: sparse COO matrix from create_path_matrix
+    """
+    key = (relation_path, tuple(structure.relation_paths[relation_path]["hops"]))
+    if key not in skeleton.path_matrices:
+        skeleton.path_matrices[key] = create_path_matrix(structure, skeleton, relation_path)
+    return skeleton.path_matrices[key]
+
+def create_path_matrix(structure: RelationalCausalStructure, skeleton: RelationalSkeleton, relation_path: str) -> torch.Tensor:
+    """ Sparse adjacency matrix of a relation path, the product of the adjacency matrices of its hops
+
+    Args:
+        structure (RelationalCausalStructure): contains schema, edges and relation paths
+        skeleton (RelationalSkeleton): contains all instances
+        relation_path (str): relation names joined with dots
+
+    Returns:
+        torch.Tensor: sparse COO matrix with one row per instance of the start entity, 
+                      nonzero where instances are connected through the path
+    """
+    path_mat = None
+    for relation, from_entity, to_entity in structure.relation_paths[relation_path]["hops"]:
+        hop_mat = create_relation_matrix(skeleton, relation, from_entity, to_entity)
+        path_mat = hop_mat if path_mat is None else torch.sparse.mm(path_mat, hop_mat).coalesce()
+    return path_mat
+
 def get_node_name(instance: str, attribute: str) -> str:
     """ Returns node name for building ground graphs instance.attribute
         Naming convention is instance.attribute 
@@ -253,6 +467,7 @@ def get_node_name(instance: str, attribute: str) -> str:
     """
     return '.'.join([instance, attribute])
 
+@instrument.instrumented("relational.ground_graph")
 def create_ground_graph(structure: RelationalCausalStructure, skeleton: RelationalSkeleton) -> nx.DiGraph:
     """ Creates an abstract ground graph for the given relational dataset
 
@@ -294,7 +509,7 @@ def create_ground_graph(structure: RelationalCausalStructure, skeleton: Relation
             entity_0 = skeleton.get_instance_type(instance_edge[0])
             entity_1 = skeleton.get_instance_type(instance_edge[1])
             # Add edges between entities
-            for relational_edge in structure.edges[relation_type]:
+            for relational_edge in structure.edges.get(relation_type, []):
                 if relational_edge.parent.entity == entity_0 and relational_edge.child.entity == entity_1:
                     parent_node_name = get_node_name(instance_edge[0],relational_edge.parent.attribute)
                     child_node_name = get_node_name(instance_edge[1],relational_edge.child.attribute)
@@ -305,8 +520,22 @@ def create_ground_graph(structure: RelationalCausalStructure, skeleton: Relation
                     child_node_name = get_node_name(instance_edge[0],relational_edge.child.attribute)
                     ground_graph.add_edge(parent_node_name, child_node_name)
 
+    # Edges through relation paths connect every pair of instances joined by the composed adjacency matrix
+    for relation_path, path in structure.relation_paths.items():
+        start, end = path["entities"]
+        start_names = skeleton.entity_instances[start]["names"]
+        end_names = skeleton.entity_instances[end]["names"]
+        rows, cols = get_path_matrix(structure, skeleton, relation_path).indices().tolist()
+        for relational_edge in structure.edges[relation_path]:
+            for row, col in zip(rows, cols):
+                parent_node_name = get_node_name(start_names[row], relational_edge.parent.attribute)
+                child_node_name = get_node_name(end_names[col], relational_edge.child.attribute)
+                if parent_node_name != child_node_name:
+                    ground_graph.add_edge(parent_node_name, child_node_name)
+
     return ground_graph
 
+@instrument.instrumented("relational.subgraph")
 def create_subgraph_for_ITE(ground_graph: nx.DiGraph, treatment: InstanceNode, outcome: InstanceNode, cutoff = 10) -> nx.DiGraph:
     """ Obtain all nodes on the path between treatment and outcome in the abstract ground graph
 
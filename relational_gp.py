@@ -1,29 +1,112 @@
-import numpy as np
-import GPy
+import math
+import gpytorch
+import torch
+
+# Import classes and functions for relational models
+from relational import *
+from model import NodeGPModel, get_node_data, get_skeleton_values
+from policy import get_dtype
 
 class RelationalGP:
+    """
+    GP priors for every node of a relational causal structure, with one RBF kernel per attribute.
+    The kernel of a node is the product of the kernels of its parent attributes, applied to the
+    columns of get_node_data, so it is built for any schema and structure.
+    """
 
-    def __init__(self, lengthscale = 0.1, variance = 0.1):
+    def __init__(self, structure: RelationalCausalStructure, lengthscale = 0.1, variance = 0.1, noise = 0.1):
+        self.structure = structure
         self.lengthscale = lengthscale
         self.variance = variance
+        self.noise = noise
         self.params = {}
+        self.build_param_dict()
 
     def build_param_dict(self):
-        pass
-
-    def model(self):
-        state_policy_kernel = GPy.kern.RBF(input_dim = 1, 
-                                           variance = self.params['state']['policy']['variance'],
-                                           lengthscale = self.params['state']['policy']['lengthscale'])
-        town_policy_kernel = GPy.kern.RBF(input_dim = 1, 
-                                          variance = self.params['town']['policy']['variance'],
-                                          lengthscale = self.params['town']['policy']['lengthscale'])
-        town_prevalence_kernel = GPy.kern.RBF(input_dim = 1, 
-                                              variance = self.params['town']['prevalence']['variance'],
-                                              lengthscale = self.params['town']['prevalence']['lengthscale'])  
-        business_occupancy_kernel = GPy.kern.RBF(input_dim = 1, 
-                                                 variance = self.params['business']['policy']['variance'],
-                                                 lengthscale = self.params['business']['policy']['lengthscale'])
-
-                            
-                                            
+        # Key is [entity_name][attribute_name] and value is a dict with the variance and lengthscale of its kernel
+        self.params = {}
+        for entity, attributes in self.structure.schema.attribute_classes.items():
+            self.params[entity] = {}
+            for attribute in attributes:
+                self.params[entity][attribute] = {'variance': self.variance, 'lengthscale': self.lengthscale}
+
+    def get_parent_params(self, node: RelationalNode) -> list:
+        """ Kernel parameters of every parent of a node, in the column order of get_node_data
+
+        Args:
+            node (RelationalNode): child node
+
+        Returns:
+            list: dicts with the variance and lengthscale of each parent attribute
+        """
+        return [self.params[edge.parent.entity][edge.parent.attribute] for _, edge in self.structure.get_incoming_edges(node.entity, node.attribute)]
+
+    def set_kernel_params(self, kernel: gpytorch.kernels.ScaleKernel, node: RelationalNode):
+        """ Copy the parameters of the parent attributes into a ScaleKernel over a ProductKernel of RBF kernels
+
+        The product of the parent variances becomes the output scale, since RBF kernels in gpytorch have no variance.
+
+        Args:
+            kernel (gpytorch.kernels.ScaleKernel): kernel of the node
+            node (RelationalNode): child node
+        """
+        parent_params = self.get_parent_params(node)
+        for rbf_kernel, params in zip(kernel.base_kernel.kernels, parent_params):
+            rbf_kernel.lengthscale = params['lengthscale']
+        kernel.outputscale = math.prod(params['variance'] for params in parent_params)
+
+    def kernel(self, node: RelationalNode) -> gpytorch.kernels.ScaleKernel:
+        """ Covariance function of a node over the values of its parents
+
+        Args:
+            node (RelationalNode): child node
+
+        Returns:
+            gpytorch.kernels.ScaleKernel: product of one RBF kernel per parent, or None for root nodes
+        """
+        num_parents = len(self.structure.get_incoming_edges(node.entity, node.attribute))
+        if num_parents == 0:
+            return None
+        rbf_kernels = [gpytorch.kernels.RBFKernel(active_dims = [i]) for i in range(num_parents)]
+        kernel = gpytorch.kernels.ScaleKernel(gpytorch.kernels.ProductKernel(*rbf_kernels)).to(get_dtype())
+        self.set_kernel_params(kernel, node)
+        return kernel
+
+    def model(self, skeleton: RelationalSkeleton, adj_mat_dict: dict) -> dict:
+        """ Node GPs with the parameters of the param dict, for every node that has parents
+
+        Args:
+            skeleton (RelationalSkeleton): contains all instances
+            adj_mat_dict (dict): adjacency matrices from create_adj_mat_dict
+
+        Returns:
+            dict: key is a RelationalNode and value is a NodeGPModel in eval mode
+        """
+        values = get_skeleton_values(self.structure, skeleton)
+        models = {}
+        for node in sorted(self.structure.nodes):
+            train_x, parents = get_node_data(self.structure, adj_mat_dict, node.entity, node.attribute, values)
+            if not parents:
+                continue
+            likelihood = gpytorch.likelihoods.GaussianLikelihood()
+            model = NodeGPModel(train_x, values[node], likelihood, parents).to(get_dtype())
+            self.set_kernel_params(model.covar_module, node)
+            likelihood.noise = self.noise
+            model.eval()
+            likelihood.eval()
+            models[node] = model
+        return models
+
+def log_marginal_likelihood(model: NodeGPModel) -> torch.Tensor:
+    """ Log marginal likelihood of the training data of a node GP, summed over instances
+
+    Args:
+        model (NodeGPModel): node GP
+
+    Returns:
+        torch.Tensor: log marginal likelihood
+    """
+    train_x = model.train_inputs[0]
+    with torch.no_grad(), model.solver_context():
+        prior = model.likelihood(model.forward(train_x))
+        return prior.log_prob(model.train_targets)
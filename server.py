@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Import classes and functions for relational models
+from relational import *
+from model import fit_relational_scm
+from estimation import batch_effect_estimation, prepare_sweep
+from checkpoint import load_scm
+from cache import GraphCache
+import instrument
+
+class ServerMetrics:
+    """
+    Latency and throughput of the effect queries answered by the server
+    """
+    def __init__(self, max_samples: int = 10000) -> None:
+        self.max_samples = max_samples
+        self.start = time.perf_counter()
+        self.latencies = [] # seconds from arrival to answer of the most recent queries
+        self.batch_sizes = [] # queries per batched evaluation
+        self.num_queries = 0
+        self.num_errors = 0
+
+    def record_batch(self, latencies: list):
+        self.num_queries += len(latencies)
+        self.latencies = (self.latencies + latencies)[-self.max_samples:]
+        self.batch_sizes = (self.batch_sizes + [len(latencies)])[-self.max_samples:]
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            'queries': self.num_queries,
+            'errors': self.num_errors,
+            'batches': len(self.batch_sizes),
+            'uptime_seconds': elapsed,
+            'queries_per_second': self.num_queries / elapsed if elapsed > 0 else 0.,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.
+        }
+        if self.latencies:
+            for q in [50, 90, 99]:
+                summary[f'latency_p{q}_ms'] = float(np.percentile(self.latencies, q)) * 1e3
+        summary['instrument'] = instrument.get_stats() if instrument.is_enabled() else {}
+        return summary
+
+class EffectBatcher:
+    """
+    Collects effect queries that arrive within a short window and answers them with one batched
+    counterfactual sweep, run in a worker pool so that the event loop keeps accepting requests.
+    """
+
+    def __init__(self, scm: RelationalSCM, skeleton: RelationalSkeleton, adj_mat_dict: dict, window: float = 0.005,
+                 max_batch_size: int = 256, max_workers: int = 1, metrics: ServerMetrics = None) -> None:
+        self.scm = scm
+        self.skeleton = skeleton
+        self.adj_mat_dict = adj_mat_dict
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.metrics = ServerMetrics() if metrics is None else metrics
+        self.pending = [] # (query, future, arrival time) tuples waiting for the next batch
+        self.flush_task = None
+        # Observed values, parent maps and factual means of the skeleton are shared by all batches,
+        # and preparing them also fills the posterior caches before workers share the models
+        self.sweep_state = prepare_sweep(scm, skeleton, adj_mat_dict)
+
+    async def submit(self, query: dict) -> float:
+        """ Queue a query and wait for its effect
+
+        Args:
+            query (dict): contains 'treatment' and 'outcome' as [entity, attribute, instance] lists,
+                          and optionally 'treatment_value' and 'control_value'
+
+        Returns:
+            float: individual effect of the treatment instance on the outcome instance
+        """
+        self.check_query(query)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((query, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush_after_window())
+        return await future
+
+    def check_query(self, query: dict):
+        # Reject malformed queries and unknown instances before they are queued, so that they never fail a whole batch
+        for key in ['treatment', 'outcome']:
+            instance = InstanceNode(*query[key])
+            if self.skeleton.instance_type.get(instance.instance) != instance.entity:
+                raise KeyError(f"Unknown {key} instance {instance.instance} of entity {instance.entity}")
+        float(query.get('treatment_value', 1.))
+        float(query.get('control_value', 0.))
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self._flush()
+
+    def _flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        # Queries with the same intervention values share one sweep
+        groups = {}
+        for item in batch:
+            query = item[0]
+            key = (float(query.get('treatment_value', 1.)), float(query.get('control_value', 0.)))
+            groups.setdefault(key, []).append(item)
+        for (treatment_value, control_value), items in groups.items():
+            asyncio.ensure_future(self._evaluate(items, treatment_value, control_value))
+
+    async def _evaluate(self, items: list, treatment_value: float, control_value: float):
+        try:
+            treatments = [InstanceNode(*item[0]['treatment']) for item in items]
+            outcomes = [InstanceNode(*item[0]['outcome']) for item in items]
+            effects = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._compute, treatments, outcomes, treatment_value, control_value)
+        except Exception as e:
+            self.metrics.num_errors += len(items)
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        now = time.perf_counter()
+        for (_, future, _), effect in zip(items, effects.tolist()):
+            if not future.done():
+                future.set_result(effect)
+        self.metrics.record_batch([now - arrival for _, _, arrival in items])
+
+    def _compute(self, treatments: list, outcomes: list, treatment_value: float, control_value: float):
+        with instrument.timer("server.batch"):
+            return batch_effect_estimation(self.scm, self.skeleton, self.adj_mat_dict, treatments, outcomes,
+                                           treatment_value, control_value, paired = True, state = self.sweep_state)
+
+    def shutdown(self):
+        self.executor.shutdown(wait = False)
+
+class EffectServer:
+    """
+    Minimal HTTP server for effect queries on localhost
+
+    POST /effect with a JSON query returns {"effect": value}, and GET /metrics returns the server metrics.
+    """
+
+    def __init__(self, batcher: EffectBatcher, host: str = '127.0.0.1', port: int = 8765) -> None:
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.shutdown()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Serving effect queries on http://{self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Connections are kept alive so that clients can send many queries
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self._route(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes):
+        if method == 'GET' and path == '/metrics':
+            return '200 OK', self.batcher.metrics.summary()
+        if method == 'POST' and path == '/effect':
+            try:
+                query = json.loads(body)
+                self.batcher.check_query(query)
+            except (ValueError, KeyError, TypeError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            try:
+                return '200 OK', {'effect': await self.batcher.submit(query)}
+            except Exception as e:
+                # Failures of the batched computation, e.g. a Cholesky error, are server errors
+                return '500 Internal Server Error', {'error': f"{type(e).__name__}: {e}"}
+        return '404 Not Found', {'error': f"No route for {method} {path}"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve batched effect queries for a fitted relational SCM")
+    parser.add_argument('--schema', default = 'example/covid_schema.json')
+    parser.add_argument('--skeleton', default = 'example/covid_skeleton.json')
+    parser.add_argument('--structure', default = 'example/covid_structure.json')
+    parser.add_argument('--checkpoint', default = None, help = "directory written by save_scm, the SCM is fitted if missing")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--window', type = float, default = 0.005, help = "seconds to wait for more queries before a batch")
+    parser.add_argument('--max-batch-size', type = int, default = 256)
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--cache-dir', default = '.relational_cache', help = "directory of the adjacency matrix cache, reused across restarts")
+    args = parser.parse_args()
+
+    schema = RelationalSchema()
+    schema.load_from_file(args.schema)
+    skeleton = RelationalSkeleton(schema)
+    skeleton.load_from_file(schema, args.skeleton)
+    structure = RelationalCausalStructure(schema)
+    structure.load_edges_from_file(args.structure)
+    adj_mat_dict = GraphCache(args.cache_dir).get_adj_mat_dict(structure, skeleton)
+
+    if args.checkpoint is not None:
+        scm = load_scm(structure, args.checkpoint)
+    else:
+        scm = fit_relational_scm(RelationalSCM(structure), skeleton, adj_mat_dict)
+
+    instrument.enable()
+    batcher = EffectBatcher(scm, skeleton, adj_mat_dict, args.window, args.max_batch_size, args.workers)
+    asyncio.run(EffectServer(batcher, args.host, args.port).serve_forever())
@@ -0,0 +1,26 @@
+import os
+import sys
+from collections import namedtuple
+import pytest
+
+# Modules of the package live at the top level of the repository
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from relational import *
+
+EXAMPLE_DIR = os.path.join(ROOT_DIR, 'example')
+
+CovidExample = namedtuple('CovidExample', 'schema structure skeleton adj_mat_dict')
+
+@pytest.fixture(scope = 'module')
+def covid() -> CovidExample:
+    """ Schema, structure, skeleton and adjacency matrices of the covid example
+    """
+    schema = RelationalSchema()
+    schema.load_from_file(os.path.join(EXAMPLE_DIR, 'covid_schema.json'))
+    skeleton = RelationalSkeleton(schema)
+    skeleton.load_from_file(schema, os.path.join(EXAMPLE_DIR, 'covid_skeleton.json'))
+    structure = RelationalCausalStructure(schema)
+    structure.load_edges_from_file(os.path.join(EXAMPLE_DIR, 'covid_structure.json'))
+    return CovidExample(schema, structure, skeleton, create_adj_mat_dict(structure, skeleton))
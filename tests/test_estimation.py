@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from relational import *
+from model import fit_relational_scm
+from estimation import get_batch_inputs, get_parent_maps, batch_effect_estimation, counterfactual_sweep, prepare_sweep
+
+@pytest.fixture(scope = 'module')
+def covid_scm(covid):
+    return fit_relational_scm(RelationalSCM(covid.structure), covid.skeleton, covid.adj_mat_dict, training_iter = 10)
+
+def full_sweep(scm, adj_mat_dict, values, interventions):
+    # Evaluates every node GP at every instance of every row
+    counterfactuals = {}
+    for node in scm.topological_ordering:
+        counterfactual = values[node].expand(len(next(iter(interventions.values()))[0]), -1)
+        model = scm.functions.get(node)
+        if model is not None:
+            parent_maps = get_parent_maps(scm.structure, adj_mat_dict, node)
+            factual = get_batch_inputs(parent_maps, {parent: values[parent].unsqueeze(0) for parent, _ in parent_maps})
+            counterfactual = values[node] + model.predict_mean(get_batch_inputs(parent_maps, counterfactuals)) - model.predict_mean(factual)
+        if node in interventions:
+            mask, value = interventions[node]
+            counterfactual = torch.where(mask, value, counterfactual)
+        counterfactuals[node] = counterfactual
+    return counterfactuals
+
+def test_sweep_matches_full_evaluation(covid, covid_scm):
+    state = prepare_sweep(covid_scm, covid.skeleton, covid.adj_mat_dict)
+    node = RelationalNode("town", "policy")
+    num_towns = len(state.values[node])
+    mask = torch.eye(num_towns, dtype = torch.bool)
+    interventions = {node: (mask, torch.full((num_towns, num_towns), 1.))}
+    counterfactuals = counterfactual_sweep(covid_scm, covid.skeleton, covid.adj_mat_dict, interventions, state)
+    expected = full_sweep(covid_scm, covid.adj_mat_dict, state.values, interventions)
+    for node, value in expected.items():
+        assert torch.allclose(counterfactuals[node], value, atol = 1e-5), node
+
+def test_state_is_reused_across_calls(covid, covid_scm):
+    state = prepare_sweep(covid_scm, covid.skeleton, covid.adj_mat_dict)
+    treatments = [InstanceNode("state", "policy", name) for name in covid.skeleton.entity_instances["state"]["names"]]
+    outcomes = [InstanceNode("town", "prevalence", name) for name in covid.skeleton.entity_instances["town"]["names"]]
+    with_state = batch_effect_estimation(covid_scm, covid.skeleton, covid.adj_mat_dict, treatments, outcomes, state = state)
+    without_state = batch_effect_estimation(covid_scm, covid.skeleton, covid.adj_mat_dict, treatments, outcomes)
+    assert torch.allclose(with_state, without_state)
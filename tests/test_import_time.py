@@ -0,0 +1,6 @@
+from benchmark import IMPORT_BUDGET, measure_import
+
+def test_relational_import_is_light():
+    record = measure_import('relational')
+    assert record['heavy_modules'] == []
+    assert record['seconds'] < IMPORT_BUDGET, f"importing relational took {record['seconds']:.3f}s"
@@ -0,0 +1,24 @@
+import torch
+
+from owscm_port.model import LogKernelComposer, process_cov, rbf_kernel_log
+
+def test_rbf_is_exact_for_inputs_far_from_zero():
+    x = torch.tensor([1000., 1000.1, 1003.])
+    composer = LogKernelComposer(3, dtype = torch.float32).add_rbf(x, x, 1.)
+    expected = rbf_kernel_log(x.double(), x.double(), 1.)
+    assert torch.allclose(composer.buffer.double(), expected, atol = 1e-3)
+    assert (composer.buffer <= 0).all()
+
+def test_batched_tiles_match_single_kernel():
+    x_1 = torch.randn(50) * 10 + 500
+    x_2 = torch.randn(30) * 10 + 500
+    lengthscale = torch.tensor([5., 20.])
+    composer = LogKernelComposer(50, 30, batch_shape = (2,)).add_rbf(x_1, x_2, lengthscale, tile_size = 7)
+    assert torch.allclose(composer.buffer, rbf_kernel_log(x_1, x_2, lengthscale), rtol = 1e-4, atol = 1e-3)
+
+def test_covariance_stays_positive_definite():
+    x = torch.linspace(1000., 1010., 200)
+    cov = LogKernelComposer(200).add_rbf(x, x, 3.).covariance(1., 1e-2)
+    expected = process_cov(rbf_kernel_log(x, x, 3.), 1., 1e-2)
+    assert torch.allclose(cov, expected, atol = 1e-5)
+    assert torch.linalg.cholesky_ex(cov).info == 0
@@ -0,0 +1,35 @@
+import pytest
+
+from relational import *
+from model import fit_relational_scm
+from estimation import batch_effect_estimation
+from partition import component_effects, component_posterior_samples, map_components
+
+@pytest.fixture(scope = 'module')
+def covid_scm(covid):
+    return fit_relational_scm(RelationalSCM(covid.structure), covid.skeleton, covid.adj_mat_dict, training_iter = 10)
+
+def test_component_effects_match_whole_skeleton(covid, covid_scm):
+    schema, structure, skeleton, adj_mat_dict = covid
+    scm = covid_scm
+    treatment = RelationalNode("state", "policy")
+    outcome = RelationalNode("town", "prevalence")
+    effects = map_components(component_effects, schema, structure, skeleton, adj_mat_dict, max_workers = 0,
+                             scm = scm, treatment = treatment, outcome = outcome)
+
+    treatments = [InstanceNode("state", "policy", name) for name in skeleton.entity_instances["state"]["names"]]
+    outcomes = [InstanceNode("town", "prevalence", name) for name in skeleton.entity_instances["town"]["names"]]
+    full_effects = batch_effect_estimation(scm, skeleton, adj_mat_dict, treatments, outcomes)
+    for i, t in enumerate(treatments):
+        for j, o in enumerate(outcomes):
+            # Pairs in different components have no effect on each other
+            assert effects.get((t, o), 0.) == pytest.approx(full_effects[i, j].item(), abs = 1e-5)
+
+def test_component_posterior_samples_cover_all_instances(covid, covid_scm):
+    schema, structure, skeleton, adj_mat_dict = covid
+    scm = covid_scm
+    node = RelationalNode("town", "prevalence")
+    samples = map_components(component_posterior_samples, schema, structure, skeleton, adj_mat_dict, max_workers = 0,
+                             scm = scm, node = node, num_samples = 5)
+    assert set(samples) == {InstanceNode("town", "prevalence", name) for name in skeleton.entity_instances["town"]["names"]}
+    assert all(s.shape == (5,) for s in samples.values())
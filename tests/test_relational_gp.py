@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import torch
+
+from relational import *
+from relational_gp import RelationalGP, log_marginal_likelihood
+from policy import ComputePolicy, get_global_policy, set_global_policy
+
+GPy = pytest.importorskip('GPy')
+
+@pytest.fixture
+def float64_policy():
+    previous_policy = get_global_policy()
+    set_global_policy(ComputePolicy(dtype = 'float64', jitter = 0.))
+    yield
+    set_global_policy(previous_policy)
+
+def test_matches_gpy_on_covid_example(covid, float64_policy):
+    _, structure, skeleton, adj_mat_dict = covid
+    relational_gp = RelationalGP(structure, lengthscale = 0.5, variance = 1.5, noise = 0.1)
+    models = relational_gp.model(skeleton, adj_mat_dict)
+    assert models
+    for node, model in models.items():
+        train_x = model.train_inputs[0].numpy()
+        train_y = model.train_targets.numpy().reshape(-1, 1)
+        gpy_kernels = [GPy.kern.RBF(input_dim = 1, active_dims = [i], **params) for i, params in enumerate(relational_gp.get_parent_params(node))]
+        gpy_kernel = gpy_kernels[0] if len(gpy_kernels) == 1 else GPy.kern.Prod(gpy_kernels)
+        gpy_model = GPy.models.GPRegression(train_x, train_y, gpy_kernel, noise_var = relational_gp.noise)
+
+        with torch.no_grad():
+            kernel = model.covar_module(model.train_inputs[0]).to_dense().numpy()
+        np.testing.assert_allclose(kernel, gpy_kernel.K(train_x), atol = 1e-6, err_msg = f"kernel of {node}")
+        np.testing.assert_allclose(model.predict_mean(model.train_inputs[0]).numpy(), gpy_model.predict(train_x)[0][:, 0],
+                                   atol = 1e-6, err_msg = f"posterior mean of {node}")
+        assert log_marginal_likelihood(model).item() == pytest.approx(gpy_model.log_likelihood(), abs = 1e-6), f"log likelihood of {node}"
@@ -0,0 +1,26 @@
+import gpytorch
+import torch
+
+from relational import *
+from model import NodeGPModel, fit_node_model, get_node_data, get_skeleton_values
+from structured import get_node_groups
+
+def test_grouped_nodes_of_covid(covid):
+    _, structure, _, adj_mat_dict = covid
+    grouped = {node for node in structure.nodes if get_node_groups(structure, adj_mat_dict, node.entity, node.attribute) is not None}
+    assert grouped == {RelationalNode("town", "policy"), RelationalNode("business", "occupancy")}
+
+def test_grouped_fit_matches_dense(covid):
+    _, structure, skeleton, adj_mat_dict = covid
+    values = get_skeleton_values(structure, skeleton, torch.float64)
+    node = RelationalNode("business", "occupancy")
+    train_x, parents = get_node_data(structure, adj_mat_dict, node.entity, node.attribute, values, torch.float64)
+    models = []
+    for group_index in [None, get_node_groups(structure, adj_mat_dict, node.entity, node.attribute)]:
+        model = NodeGPModel(train_x, values[node], gpytorch.likelihoods.GaussianLikelihood(), parents, group_index = group_index).double()
+        models.append((model, fit_node_model(model, 10)))
+    (dense, dense_losses), (grouped, grouped_losses) = models
+    assert torch.allclose(torch.tensor(dense_losses), torch.tensor(grouped_losses), atol = 1e-5)
+    test_x = train_x + 0.3
+    assert torch.allclose(dense.predict_mean(test_x), grouped.predict_mean(test_x), atol = 1e-5)
+    assert torch.allclose(dense.predict_variance(test_x), grouped.predict_variance(test_x), atol = 1e-5)